@@ -0,0 +1,193 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import json
+import argparse
+import time
+import traceback
+from update_crate import CrateMaker, MetadataCache, CacheResolver
+
+# State shared by all the repositories a worker process updates
+WORKER_STATE = {}
+
+
+def main(
+    repos,
+    defaults_file=None,
+    workers=None,
+    use_cache=True,
+    csv_records=False,
+    incremental=False,
+    offline=False,
+    recursive_dir_stats=False,
+    checksums=None,
+    reproducible=False,
+):
+    """
+    Update the crates of a list of repositories, using a pool of worker processes.
+
+    Parameters:
+        repos: a list of (repository directory, data repo url) tuples, relative directories
+            are resolved against the current working directory
+        defaults_file: path to a file of crate defaults, relative to each repository
+
+    Returns:
+        A list of results, one for each repository
+    """
+    options = {
+        "defaults_file": defaults_file,
+        "use_cache": use_cache,
+        "csv_records": csv_records,
+        "incremental": incremental,
+        "offline": offline,
+        "recursive_dir_stats": recursive_dir_stats,
+        "checksums": checksums,
+        "reproducible": reproducible,
+    }
+    # Workers change into each repository they update, so relative paths have to be resolved here
+    jobs = [(str(Path(repo_dir).resolve()), data_repo, options) for repo_dir, data_repo in repos]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(update_repo, jobs))
+    print_summary(results)
+    return results
+
+
+def read_repo_list(manifest):
+    """
+    Read a list of repositories from a manifest file.
+    Each line has a repository directory, optionally followed by the url of a data repo.
+    Blank lines and lines starting with # are ignored.
+    Relative directories are resolved against the directory of the manifest.
+    """
+    repos = []
+    manifest_dir = Path(manifest).resolve().parent
+    for line in Path(manifest).read_text().splitlines():
+        if line.strip() and not line.strip().startswith("#"):
+            repo_dir, _, data_repo = line.strip().partition(" ")
+            repos.append((str(Path(manifest_dir, repo_dir)), data_repo.strip()))
+    return repos
+
+
+def update_repo(job):
+    """
+    Update the crate of a single repository in a worker process.
+    The metadata cache, HTTP session and GitHub lookups are shared by all the
+    repositories the worker updates.
+    """
+    repo_dir, data_repo, options = job
+    start = time.perf_counter()
+    result = {"repo": repo_dir, "data_repo": data_repo, "ok": True, "error": None}
+    try:
+        repo_path = Path(repo_dir)
+        defaults = {}
+        if options["defaults_file"] and Path(repo_path, options["defaults_file"]).exists():
+            defaults = json.loads(Path(repo_path, options["defaults_file"]).read_text())
+        if (options["use_cache"] or options["offline"]) and "cache" not in WORKER_STATE:
+            WORKER_STATE["cache"] = MetadataCache()
+        crate_maker = CrateMaker(
+            defaults=defaults,
+            data_repo=data_repo,
+            cache=WORKER_STATE.get("cache"),
+            csv_records=options["csv_records"],
+            incremental=options["incremental"],
+            recursive_dir_stats=options["recursive_dir_stats"],
+            checksums=options["checksums"],
+            reproducible=options["reproducible"],
+            working_dir=repo_path,
+            resolver=CacheResolver(WORKER_STATE["cache"]) if options["offline"] else None,
+        )
+        crate_maker.http_session = WORKER_STATE.get("http_session")
+        crate_maker.host_limits = WORKER_STATE.setdefault("host_limits", {})
+        crate_maker.gh_client = WORKER_STATE.get("gh_client")
+        crate_maker.gh_authenticated = WORKER_STATE.get("gh_authenticated", False)
+        crate_maker.gh_repos = WORKER_STATE.setdefault("gh_repos", {})
+        crate_maker.gh_branches = WORKER_STATE.setdefault("gh_branches", {})
+        crate_maker.update_crate()
+        WORKER_STATE["http_session"] = crate_maker.http_session
+        WORKER_STATE["gh_client"] = crate_maker.gh_client
+        WORKER_STATE["gh_authenticated"] = crate_maker.gh_authenticated
+    except Exception:
+        result["ok"] = False
+        result["error"] = traceback.format_exc(limit=3)
+    result["seconds"] = round(time.perf_counter() - start, 2)
+    return result
+
+
+def print_summary(results):
+    width = max([len(result["repo"]) for result in results] + [4])
+    print(f"{'Repo':<{width}}  Status  Seconds")
+    for result in results:
+        status = "ok" if result["ok"] else "FAILED"
+        print(f"{result['repo']:<{width}}  {status:<6}  {result['seconds']:>7}")
+    failed = [result for result in results if not result["ok"]]
+    for result in failed:
+        print(f"\n{result['repo']}:\n{result['error']}")
+    print(f"\n{len(results) - len(failed)} updated, {len(failed)} failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Update the crates of a batch of repositories in one process pool"
+    )
+    parser.add_argument("repos", nargs="*", help="Repository directories")
+    parser.add_argument(
+        "--manifest", type=str, help="File listing repository directories (and data repos)"
+    )
+    parser.add_argument(
+        "--defaults",
+        type=str,
+        help="File containing Crate default values, relative to each repository",
+        required=False,
+    )
+    parser.add_argument("--workers", type=int, help="Number of worker processes")
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Don't use the cache of web page metadata"
+    )
+    parser.add_argument(
+        "--csv-records",
+        action="store_true",
+        help="Count CSV records, allowing for newlines in quoted fields, rather than lines",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only regenerate notebooks that have changed since the last incremental run",
+    )
+    parser.add_argument(
+        "--recursive-dir-stats",
+        action="store_true",
+        help="Describe directories by the number, total size and formats of the files in them and their subdirectories",
+    )
+    parser.add_argument(
+        "--checksums",
+        type=str,
+        nargs="*",
+        help="Add checksums of local files with these algorithms (default: sha256), eg sha256 xxh3_64",
+    )
+    parser.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Sort entities and keep old timestamps if nothing else has changed, so an unchanged crate isn't rewritten",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Don't use the network, only metadata from the cache (however old it is)",
+    )
+    args = parser.parse_args()
+    repos = [(repo_dir, "") for repo_dir in args.repos]
+    if args.manifest:
+        repos += read_repo_list(args.manifest)
+    results = main(
+        repos,
+        defaults_file=args.defaults,
+        workers=args.workers,
+        use_cache=not args.no_cache,
+        csv_records=args.csv_records,
+        incremental=args.incremental,
+        offline=args.offline,
+        recursive_dir_stats=args.recursive_dir_stats,
+        checksums=args.checksums if args.checksums != [] else ["sha256"],
+        reproducible=args.reproducible,
+    )
+    if not all(result["ok"] for result in results):
+        raise SystemExit(1)
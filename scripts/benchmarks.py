@@ -0,0 +1,246 @@
+"""
+Performance benchmarks for crate generation.
+
+These need pytest-benchmark, and run against synthetic repositories with a local
+stand-in web server, so no network access is required:
+
+    python -m pytest scripts/benchmarks.py
+
+Set CRATE_BENCHMARK_SCALE to multiply the size of the synthetic repositories.
+"""
+
+import os
+import json
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from update_crate import CrateMaker, MetadataCache, RepoContext, count_lines, count_csv_records
+import update_crate
+
+SCALE = int(os.environ.get("CRATE_BENCHMARK_SCALE", 1))
+REPO_URL = "https://github.com/GLAM-Workbench/synthetic-repo/"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers every GET with a small HTML page titled with its path, and every HEAD
+    with the headers used by get_web_file_stats.
+    """
+
+    def send_headers(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified", "Fri, 13 Sep 2024 07:01:28 GMT")
+        self.end_headers()
+
+    def do_GET(self):
+        body = f"<html><head><title>Page {self.path}</title></head><body></body></html>".encode()
+        self.send_headers(body)
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_headers(b"")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def make_synthetic_repo(path, server_url, notebooks=10, actions=2, files=3, authors=5, rows=1000):
+    """
+    Create a repository of notebooks with rocrate metadata, local data files,
+    and links to pages and files on the stand-in server.
+    """
+    Path(path, "data").mkdir(parents=True, exist_ok=True)
+    row = "1,Trove,The Sydney Morning Herald,1842-01-01,https://nla.gov.au/nla.news-title35\n"
+    for nb_index in range(notebooks):
+        nb_actions = []
+        for action_index in range(actions):
+            results = []
+            for file_index in range(files):
+                local_path = f"data/nb{nb_index}_action{action_index}_{file_index}.csv"
+                Path(path, local_path).write_text("id,source,title,date,url\n" + row * rows)
+                results.append({"localPath": local_path, "subjectOf": f"{server_url}/docs/{nb_index}"})
+            results.append({"url": f"{server_url}/data/nb{nb_index}_action{action_index}.csv"})
+            nb_actions.append({"name": f"Run {action_index}", "result": results})
+        metadata = {
+            "name": f"Synthetic notebook {nb_index}",
+            "description": "A notebook generated for benchmarking.",
+            "mainEntityOfPage": f"{server_url}/notebooks/{nb_index}/",
+            "author": [
+                {
+                    "name": f"Author{(nb_index + author_index) % (authors * 2)}, Test",
+                    "orcid": f"0000-0000-0000-{(nb_index + author_index) % (authors * 2):04d}",
+                    "mainEntityOfPage": f"{server_url}/people/{(nb_index + author_index) % (authors * 2)}",
+                }
+                for author_index in range(authors)
+            ],
+            "license": "mit",
+            "action": nb_actions,
+        }
+        notebook = {
+            "cells": [],
+            "metadata": {"rocrate": metadata},
+            "nbformat": 4,
+            "nbformat_minor": 5,
+        }
+        Path(path, f"synthetic_{nb_index}.ipynb").write_text(json.dumps(notebook))
+    subprocess.run(["git", "init", "-q"], cwd=path, check=True)
+    subprocess.run(
+        ["git", "remote", "add", "origin", REPO_URL.rstrip("/") + ".git"], cwd=path, check=True
+    )
+    return path
+
+
+@pytest.fixture(scope="module")
+def synthetic_repo(tmp_path_factory, server_url):
+    return make_synthetic_repo(
+        tmp_path_factory.mktemp("synthetic-repo"),
+        server_url,
+        notebooks=10 * SCALE,
+        actions=2,
+        files=3,
+        authors=5,
+        rows=1000 * SCALE,
+    )
+
+
+@pytest.fixture(scope="module")
+def large_csv(tmp_path_factory):
+    csv_path = Path(tmp_path_factory.mktemp("large-data"), "large.csv")
+    row = '1,Trove,"The Sydney Morning Herald, ""NSW""",1842-01-01,https://nla.gov.au/nla.news-title35\n'
+    with csv_path.open("w") as csv_file:
+        for _ in range(100 * SCALE):
+            csv_file.write(row * 1000)
+    return csv_path
+
+
+@pytest.fixture(autouse=True)
+def restore_cwd(monkeypatch):
+    # CrateMaker changes the working directory to the repository it describes
+    monkeypatch.chdir(Path.cwd())
+
+
+def make_crate_maker(repo_path, cache_path):
+    """
+    Create a CrateMaker for a synthetic repo with an empty cache, except for
+    the GitHub details of the synthetic repo itself (which doesn't exist).
+    """
+    cache = MetadataCache(cache_path)
+    cache.set(REPO_URL, title="Synthetic repo")
+    cache.set_default_branch("GLAM-Workbench/synthetic-repo", "main")
+    # The stand-in server doesn't need protecting from too many requests
+    return CrateMaker(defaults={}, cache=cache, working_dir=repo_path, host_rate=None)
+
+
+def test_update_crate(benchmark, synthetic_repo, tmp_path):
+    rounds = iter(range(1000))
+
+    def setup():
+        return (make_crate_maker(synthetic_repo, Path(tmp_path, f"cache-{next(rounds)}.sqlite")),), {}
+
+    benchmark.pedantic(lambda crate_maker: crate_maker.update_crate(), setup=setup, rounds=3)
+    graph = json.loads(Path(synthetic_repo, "ro-crate-metadata.json").read_text())["@graph"]
+    assert len([e for e in graph if "SoftwareSourceCode" in e["@type"]]) == 10 * SCALE
+
+
+def test_update_crate_warm_cache(benchmark, synthetic_repo, tmp_path):
+    cache_path = Path(tmp_path, "cache.sqlite")
+    make_crate_maker(synthetic_repo, cache_path).update_crate()
+    benchmark.pedantic(
+        lambda crate_maker: crate_maker.update_crate(),
+        setup=lambda: ((make_crate_maker(synthetic_repo, cache_path),), {}),
+        rounds=3,
+    )
+
+
+def test_update_crate_incremental(benchmark, synthetic_repo, tmp_path):
+    cache_path = Path(tmp_path, "cache.sqlite")
+
+    def make_incremental():
+        crate_maker = make_crate_maker(synthetic_repo, cache_path)
+        crate_maker.incremental = True
+        return (crate_maker,), {}
+
+    make_incremental()[0][0].update_crate()
+    benchmark.pedantic(lambda crate_maker: crate_maker.update_crate(), setup=make_incremental, rounds=3)
+
+
+def test_count_lines(benchmark, large_csv):
+    assert benchmark(count_lines, large_csv) == 100_000 * SCALE
+
+
+def test_count_csv_records(benchmark, large_csv):
+    assert benchmark(count_csv_records, large_csv) == 100_000 * SCALE
+
+
+def test_get_local_file_stats(benchmark, large_csv):
+    crate_maker = CrateMaker(working_dir=large_csv.parent)
+
+    def get_stats():
+        crate_maker.row_counts = {}
+        return crate_maker.get_local_file_stats(large_csv)
+
+    assert benchmark(get_stats)["size"] == 100_000 * SCALE
+
+
+def test_add_people(benchmark):
+    from rocrate.rocrate import ROCrate
+
+    authors = [
+        {"name": f"Author{index}, Test", "orcid": f"0000-0000-0000-{index:04d}"}
+        for index in range(200 * SCALE)
+    ]
+    crate_maker = CrateMaker()
+
+    def add_people():
+        crate_maker.crate = ROCrate()
+        return crate_maker.add_people(authors)
+
+    assert len(benchmark(add_people)) == 200 * SCALE
+
+
+def test_add_files(benchmark, synthetic_repo, server_url):
+    from rocrate.rocrate import ROCrate
+
+    crate_maker = CrateMaker(working_dir=synthetic_repo)
+    files = [
+        {"localPath": str(path.relative_to(synthetic_repo))}
+        for path in sorted(Path(synthetic_repo, "data").glob("*.csv"))
+    ]
+    # Resolve the repo link up front, so only the file handling is measured
+    crate_maker.repo_context = RepoContext("synthetic-repo", REPO_URL, "main", None)
+    crate_maker.page_titles[REPO_URL] = "Synthetic repo"
+
+    def add_files():
+        crate_maker.crate = ROCrate()
+        crate_maker.row_counts = {}
+        return crate_maker.add_files(files)
+
+    assert len(benchmark(add_files)) == len(files)
+
+
+def test_import_time(benchmark):
+    def import_update_crate():
+        subprocess.run(
+            [sys.executable, "-c", "import update_crate"],
+            cwd=Path(update_crate.__file__).parent,
+            check=True,
+        )
+
+    benchmark.pedantic(import_update_crate, rounds=5)
@@ -2,18 +2,20 @@ from rocrate.rocrate import ROCrate
 import json
 from pathlib import Path
 import re
+from update_crate import EntityIndex, listify
 
-def get_create_action(crate, datafile):
-    actions = crate.get_by_type("CreateAction")
-    for action in actions:
-        props = action.properties()
-        for result in props["result"]:
+def get_create_action(crate, datafile, index=None):
+    # Only the actions that refer to the file need to be checked
+    index = index or EntityIndex(crate.get_entities(), crate.resolve_id)
+    for action in index.get_referrers(datafile, type_="CreateAction"):
+        for result in listify(action.properties().get("result", [])):
             if result["@id"] == datafile:
                 return action
 
 crate = ROCrate("./")
+index = EntityIndex(crate.get_entities(), crate.resolve_id)
 root = crate.get("./").properties()
-gw_section = crate.get(root["mainEntityOfPage"]["@id"])
+gw_section = index.get(root["mainEntityOfPage"]["@id"])
 
 md = f"# {root['name']}\n\n"
 
@@ -25,15 +27,15 @@ md += f"For more information and documentation see the [{gw_section['name']}]({g
 md += "\n\n## Notebooks\n"
 details = "\n\n## Dataset details"
 
-for nb in crate.get_by_type(["File", "SoftwareSourceCode"]):
+for nb in index.get_by_type(["File", "SoftwareSourceCode"]):
     md += f'- [{nb["name"]}]({nb["url"]})\n'
 
 datasets = []
-for action in crate.get_by_type("CreateAction"):
+for action in index.get_by_type("CreateAction"):
     print(action)
     for result in action["result"]:
-        dataset = crate.get(result["@id"])
-        source = crate.get(dataset["isPartOf"]["@id"])
+        dataset = index.get(result["@id"])
+        source = index.get(dataset["isPartOf"]["@id"])
         datasets.append(source)
 
 if datasets:
@@ -1,6 +1,14 @@
 from update_crate import *
+import update_crate
+import batch_update
 import pytest
+import subprocess
+import sys
+import requests
+import git
+from github import Github
 from rocrate.rocrate import ROCrate, ContextEntity
+from rocrate.model.person import Person
 from nbformat import NotebookNode
 import nbformat
 from pathlib import Path
@@ -8,7 +16,9 @@ import json
 from git import Repo
 import pandas as pd
 import shutil
+import hashlib
 import datetime
+import time
 
 CONTEXT_PROPERTIES = [
     "author",
@@ -45,6 +55,20 @@ def test_delistify_list_multiple():
     assert delistify(["a", "b"]) == ["a", "b"]
 
 
+def test_import_time():
+    # Heavy dependencies should only be loaded when they're used
+    heavy = ["rocrate", "git", "github", "bs4", "lxml", "requests", "arrow", "nbformat"]
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import update_crate"],
+        cwd=Path(update_crate.__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = [line.split("|")[-1].strip() for line in result.stderr.splitlines()]
+    assert [module for module in heavy if module in imported] == []
+
+
 @pytest.fixture
 def crate():
     crate = CrateMaker()
@@ -93,10 +117,20 @@ def nb_path(tmp_path_factory):
 
 
 class PageResponse:
-    text = (
-        "<html><head><title>An interesting web page</title></head><body></body></html>"
+    content = (
+        b"<html><head><title>An interesting web page</title></head><body></body></html>"
     )
     ok = True
+    status_code = 200
+    headers = {"Content-Type": "text/html; charset=utf-8"}
+    closed = False
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+    def close(self):
+        self.closed = True
 
 
 class GitHubRepo:
@@ -117,6 +151,36 @@ class GenericClass:
     pass
 
 
+class GitHubTreeRepo(GitHubRepo):
+    def get_git_tree(self, sha, recursive=False):
+        tree = GenericClass()
+        tree.tree = []
+        for path, element_type, size in [
+            ("data", "tree", None),
+            ("data/A6119-items.csv", "blob", 12000),
+            ("data/unused.csv", "blob", 500),
+        ]:
+            element = GenericClass()
+            element.path = path
+            element.type = element_type
+            element.size = size
+            tree.tree.append(element)
+        return tree
+
+    def get_contents(self, *args, **kwargs):
+        raise AssertionError("Indexed files shouldn't be requested individually")
+
+
+class GraphQLRequester:
+    def __init__(self):
+        self.queries = []
+
+    def graphql_query(self, query, variables):
+        self.queries.append(query)
+        history = {"nodes": [{"committedDate": "2025-03-01T10:00:00Z"}]}
+        return {}, {"data": {"repository": {"object": {"f0": history}}}}
+
+
 class GitRepo:
     remotes = GenericClass()
     remotes.origin = GenericClass()
@@ -175,16 +239,302 @@ def test_get_notebook_md(crate, nb_path):
     assert metadata["name"] == "My test notebook"
 
 
+def test_get_notebook_md_read_once(monkeypatch, crate, nb_path):
+    reads = []
+    read_nb_metadata = crate.read_nb_metadata
+
+    def counting_read(notebook):
+        reads.append(notebook)
+        return read_nb_metadata(notebook)
+
+    monkeypatch.setattr(crate, "read_nb_metadata", counting_read)
+    nbs = crate.get_notebooks(path=nb_path)
+    metadata = crate.get_nb_metadata(nbs[0])
+    metadata["name"] = "Changed"
+    assert crate.get_nb_metadata(nbs[0])["name"] == "My test notebook"
+    assert len(reads) == 1
+
+
+def test_get_notebook_md_no_rocrate(crate, tmp_path):
+    nb_file = Path(tmp_path, "no_metadata.ipynb")
+    nb_file.write_text(json.dumps({"metadata": {}, "cells": []}))
+    assert crate.get_nb_metadata(nb_file) == {}
+
+
 def test_get_page_title(crate, monkeypatch):
     def mock_get(*args, **kwargs):
         return PageResponse()
 
-    monkeypatch.setattr(requests, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "get", mock_get)
 
     title = crate.get_page_title("https://mycoolsite.com")
     assert title == "An interesting web page"
 
 
+def test_read_title():
+    class LongPageResponse(PageResponse):
+        headers = {"Content-Type": "text/html"}
+        content = (
+            b"<html><head><title>Caf\xc3\xa9 &amp; tea</title></head><body>"
+            + b"<p>filler</p>" * 100_000
+            + b"</body></html>"
+        )
+
+        def iter_content(self, chunk_size=1):
+            self.read = 0
+            for chunk in super().iter_content(chunk_size=3):
+                self.read += len(chunk)
+                yield chunk
+
+    response = LongPageResponse()
+    assert read_title(response) == "Café & tea"
+    assert response.read < 100 and response.closed
+    # Only the first bytes of a page without a title are read
+    response.content = b"<html><body>" + b"<p>filler</p>" * 100_000
+    assert read_title(response, max_bytes=1000) is None
+    assert response.read < 1010
+
+
+def test_read_title_not_html():
+    class PDFResponse(PageResponse):
+        headers = {"Content-Type": "application/pdf"}
+
+        def iter_content(self, chunk_size=1):
+            raise AssertionError("Files that aren't HTML shouldn't be read")
+
+    response = PDFResponse()
+    assert read_title(response) is None
+    assert response.closed
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MetadataCache(Path(tmp_path, "cache.sqlite"))
+
+
+class NotModifiedResponse:
+    status_code = 304
+    ok = False
+    headers = {}
+
+    def close(self):
+        pass
+
+
+def test_metadata_cache(cache):
+    cache.set("https://glam-workbench.net/", title="GLAM Workbench")
+    cache.set("https://glam-workbench.net/", etag='"abc"')
+    record = cache.get("https://glam-workbench.net/")
+    assert record["title"] == "GLAM Workbench"
+    assert cache.is_fresh(record)
+    assert cache.validators(record) == {"If-None-Match": '"abc"'}
+    assert cache.get("https://timsherratt.au") is None
+
+
+def test_metadata_cache_kinds(monkeypatch, crate, cache):
+    class CSVResponse(PageResponse):
+        headers = {"Content-Type": "text/csv", "ETag": '"abc"', "Last-Modified": "Fri, 13 Sep 2024 07:01:28 GMT"}
+
+    class CSVHead:
+        status_code = 200
+        headers = {"Content-length": 23000, "Last-Modified": "Fri, 13 Sep 2024 07:01:28 GMT"}
+
+    requested = []
+
+    def mock_get(session, url, **kwargs):
+        requested.append(("get", kwargs.get("headers")))
+        return NotModifiedResponse() if kwargs.get("headers") else CSVResponse()
+
+    def mock_head(session, url, **kwargs):
+        requested.append(("head", kwargs.get("headers")))
+        return CSVHead()
+
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    monkeypatch.setattr(requests.Session, "head", mock_head)
+    crate.cache = cache
+    # A title request doesn't stand in for a HEAD request to the same url
+    assert crate.read_page_title("https://mycoolsite.com/data.csv") is None
+    assert crate.get_head_metadata("https://mycoolsite.com/data.csv")["content_length"] == 23000
+    # Pages without titles are cached, and revalidated when they're stale
+    assert crate.read_page_title("https://mycoolsite.com/data.csv") is None
+    cache.ttl = -1
+    assert crate.read_page_title("https://mycoolsite.com/data.csv") is None
+    assert requested == [
+        ("get", None),
+        ("head", None),
+        ("get", {"If-None-Match": '"abc"', "If-Modified-Since": "Fri, 13 Sep 2024 07:01:28 GMT"}),
+    ]
+
+
+def test_metadata_cache_purge(cache):
+    cache.set("https://glam-workbench.net/", title="GLAM Workbench")
+    cache.max_age = -1
+    cache.purge()
+    assert cache.get("https://glam-workbench.net/") is None
+
+
+def test_get_page_title_cached(monkeypatch, crate, cache):
+    def mock_get(*args, **kwargs):
+        raise AssertionError("Fresh cached titles shouldn't be requested")
+
+    cache.set("https://mycoolsite.com", title="An interesting web page")
+    crate.cache = cache
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    assert crate.get_page_title("https://mycoolsite.com") == "An interesting web page"
+
+
+def test_get_page_title_revalidated(monkeypatch, crate, cache):
+    sent_headers = {}
+
+    def mock_get(*args, **kwargs):
+        sent_headers.update(kwargs["headers"])
+        return NotModifiedResponse()
+
+    cache.set("https://mycoolsite.com", title="An interesting web page", etag='"abc"')
+    cache.ttl = -1
+    crate.cache = cache
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    assert crate.get_page_title("https://mycoolsite.com") == "An interesting web page"
+    assert sent_headers == {"If-None-Match": '"abc"'}
+
+
+def test_http_request(monkeypatch, crate):
+    sent = []
+
+    def mock_get(session, url, **kwargs):
+        sent.append((session, kwargs["timeout"]))
+        return PageResponse()
+
+    crate.timeout = 5
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    crate.get_page_title("https://mycoolsite.com")
+    crate.get_page_title("https://anothersite.com")
+    assert sent[0] == sent[1] == (crate.get_http_session(), 5)
+    retry = crate.get_http_session().get_adapter("https://mycoolsite.com").max_retries
+    assert retry.total == HTTP_RETRIES
+    assert 429 in retry.status_forcelist
+    assert list(crate.host_limits) == ["mycoolsite.com", "anothersite.com"]
+    assert crate.get_host_limit("mycoolsite.com") is crate.host_limits["mycoolsite.com"]
+
+
+def test_token_bucket(monkeypatch):
+    waits = []
+    monkeypatch.setattr(time, "sleep", waits.append)
+    monkeypatch.setattr(time, "monotonic", lambda: 100.0)
+    bucket = TokenBucket(rate=2, capacity=2)
+    assert [bucket.take() for _ in range(4)] == [0, 0, 0.5, 1.0]
+    assert waits == [0.5, 1.0]
+
+
+def test_get_web_stats_cached(monkeypatch, crate, cache):
+    requests_made = []
+
+    def fake_headers(*args, **kwargs):
+        requests_made.append(args)
+        return PageHead
+
+    crate.cache = cache
+    monkeypatch.setattr(requests.Session, "head", fake_headers)
+    crate.get_web_file_stats("https://fake.url")
+    stats = crate.get_web_file_stats("https://fake.url")
+    assert len(requests_made) == 1
+    assert stats["contentSize"] == 23000
+    assert stats["dateModified"] == "2024-09-13T07:01:28+00:00"
+
+
+def test_collect_urls(crate):
+    metadata = {
+        "name": "My test notebook",
+        "mainEntityOfPage": "https://glam-workbench.net/trove-newspapers/",
+        "author": [{"name": "Sherratt, Tim", "mainEntityOfPage": "https://timsherratt.au"}],
+        "license": "mit",
+        "action": [
+            {
+                "result": [
+                    {"url": "https://glam-workbench.net/data.csv"},
+                    {"url": "https://glam-workbench.net/local.csv", "localPath": "local.csv"},
+                ]
+            }
+        ],
+    }
+    pages = set()
+    files = set()
+    local_files = set()
+    crate.collect_urls(metadata, pages, files, local_files)
+    assert pages == {"https://glam-workbench.net/trove-newspapers/", "https://timsherratt.au"}
+    assert files == {"https://glam-workbench.net/data.csv"}
+    assert local_files == {"local.csv"}
+
+
+def test_resolve_urls(monkeypatch, crate):
+    fetched = []
+
+    def fake_page_title(url):
+        fetched.append(url)
+        if "broken" in url:
+            raise requests.exceptions.ConnectionError()
+        return f"Title of {url}"
+
+    def fake_web_stats(url):
+        return {"contentSize": 2456}
+
+    monkeypatch.setattr(crate, "fetch_page_title", fake_page_title)
+    monkeypatch.setattr(crate, "fetch_web_file_stats", fake_web_stats)
+    crate.resolve_urls(
+        [
+            {
+                "workExample": ["https://glam-workbench.net/", "https://broken.site/"],
+                "action": [{"result": {"url": "https://glam-workbench.net/data.csv"}}],
+            }
+        ]
+    )
+    assert crate.get_page_title("https://glam-workbench.net/") == "Title of https://glam-workbench.net/"
+    assert "https://broken.site/" not in crate.page_titles
+    assert crate.get_web_file_stats("https://glam-workbench.net/data.csv")["contentSize"] == 2456
+    # Failures are raised when the url is needed, without fetching it again
+    with pytest.raises(requests.exceptions.ConnectionError):
+        crate.get_page_title("https://broken.site/")
+    assert sorted(fetched) == ["https://broken.site/", "https://glam-workbench.net/"]
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler()
+    with profiler.phase("add notebook", notebook="test_nb.ipynb"):
+        with profiler.phase("page titles"):
+            profiler.count_request("https://glam-workbench.net/")
+            profiler.count_cache("page titles", False)
+        with profiler.phase("page titles"):
+            profiler.count_cache("page titles", True)
+    report = profiler.report()
+    assert report["phases"]["page titles"]["calls"] == 2
+    assert report["requests"] == {"glam-workbench.net": 1}
+    assert report["cache"]["page titles"] == {"hits": 1, "misses": 1}
+    assert "50%" in profiler.summary()
+    # Columns line up, however long the names are
+    long_names = Profiler()
+    long_names.count_cache("page titles", True)
+    long_names.count_cache("resolved local file stats", True)
+    cache_table = long_names.summary().split("\n\n")[-1].splitlines()
+    assert len({len(line) for line in cache_table}) == 1
+    profiler.write(Path(tmp_path, "profile.json"))
+    assert json.loads(Path(tmp_path, "profile.json").read_text()) == report
+    profiler.write_spans(Path(tmp_path, "trace.jsonl"))
+    spans = [json.loads(line) for line in Path(tmp_path, "trace.jsonl").read_text().splitlines()]
+    parent = spans[-1]
+    assert parent["attributes"] == {"notebook": "test_nb.ipynb"}
+    assert [span["parent_span_id"] for span in spans[:2]] == [parent["span_id"]] * 2
+
+
+def test_get_page_title_profiled(monkeypatch, crate):
+    def mock_get(*args, **kwargs):
+        return PageResponse()
+
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    crate.get_page_title("https://mycoolsite.com")
+    assert crate.profiler.report()["requests"] == {"mycoolsite.com": 1}
+    assert crate.profiler.report()["phases"]["page titles"]["calls"] == 1
+
+
 def test_add_python_version(monkeypatch, crate):
 
     monkeypatch.setattr(sys, "version_info", (3, 10, 12))
@@ -218,17 +568,77 @@ def test_get_gh_repo(monkeypatch, crate):
     assert repo.name == "recordsearch"
 
 
-def test_get_gh_path(monkeypatch, crate):
+def test_get_gh_repo_memoized(monkeypatch, crate):
+    lookups = []
+
     def mock_repo(*args, **kwargs):
-        return "master"
+        lookups.append(kwargs["full_name_or_id"])
+        return GitHubRepo(*args, **kwargs)
+
+    monkeypatch.setattr(Github, "get_repo", mock_repo)
+    crate.get_gh_repo("https://github.com/GLAM-Workbench/recordsearch")
+    crate.get_default_gh_branch(
+        "https://github.com/GLAM-Workbench/recordsearch/blob/master/data/A6119-items.csv"
+    )
+    crate.get_gh_repo("https://raw.githubusercontent.com/GLAM-Workbench/recordsearch/refs/heads/master/data/A6119-items.csv")
+    assert lookups == ["GLAM-Workbench/recordsearch"]
+    assert crate.get_gh_client() is crate.get_gh_client()
+
+
+def test_get_gh_repo_threads(monkeypatch, crate):
+    from concurrent.futures import ThreadPoolExecutor
+
+    lookups = []
 
-    monkeypatch.setattr(crate, "get_default_gh_branch", mock_repo)
+    def slow_repo(*args, **kwargs):
+        lookups.append(kwargs["full_name_or_id"])
+        time.sleep(0.05)
+        return GitHubRepo(*args, **kwargs)
+
+    monkeypatch.setattr(Github, "get_repo", slow_repo)
+    urls = [f"https://github.com/GLAM-Workbench/recordsearch/blob/master/data/{index}.csv" for index in range(8)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert set(executor.map(crate.get_default_gh_branch, urls)) == {"master"}
+    assert lookups == ["GLAM-Workbench/recordsearch"]
+
+
+def test_get_gh_branch_cached(monkeypatch, crate, cache):
+    def fake_gh_repo(*args, **kwargs):
+        raise AssertionError("Cached branches shouldn't be looked up")
+
+    cache.set_default_branch("GLAM-Workbench/recordsearch", "master")
+    crate.cache = cache
+    monkeypatch.setattr(crate, "get_gh_repo", fake_gh_repo)
+    assert crate.get_default_gh_branch("https://github.com/GLAM-Workbench/recordsearch") == "master"
+
+
+def test_get_gh_path(monkeypatch, crate):
+    def fake_gh_branch(*args, **kwargs):
+        raise AssertionError("Paths shouldn't need the default branch")
+
+    monkeypatch.setattr(crate, "get_default_gh_branch", fake_gh_branch)
     path = crate.get_gh_path(
         "https://github.com/GLAM-Workbench/recordsearch/raw/refs/heads/master/data/A6119-items.csv"
     )
     assert path == "data/A6119-items.csv"
 
 
+def test_parse_gh_url():
+    assert parse_gh_url("https://github.com/GLAM-Workbench/recordsearch.git") == GitHubUrl(
+        "GLAM-Workbench", "recordsearch", None, None, "repo"
+    )
+    assert parse_gh_url(
+        "https://github.com/GLAM-Workbench/recordsearch/blob/master/series_totals_May_2021.csv"
+    ) == GitHubUrl("GLAM-Workbench", "recordsearch", "master", "series_totals_May_2021.csv", "blob")
+    gh_url = parse_gh_url(
+        "https://raw.githubusercontent.com/GLAM-Workbench/recordsearch/refs/heads/master/data/A6119-items.csv"
+    )
+    assert gh_url == GitHubUrl("GLAM-Workbench", "recordsearch", "master", "data/A6119-items.csv", "raw")
+    assert gh_url.full_name == "GLAM-Workbench/recordsearch"
+    assert parse_gh_url("https://glam-workbench.github.io/glam-workbench/") is None
+    assert parse_gh_url("https://glam-workbench.net/") is None
+
+
 def test_get_repo_info(monkeypatch, crate):
     def fake_repo(*args, **kwargs):
         return GitRepo()
@@ -239,6 +649,36 @@ def test_get_repo_info(monkeypatch, crate):
     assert repo_url == "https://github.com/GLAM-Workbench/recordsearch/"
 
 
+def test_get_repo_context(monkeypatch, crate, tmp_path):
+    opened = []
+
+    def fake_repo(*args, **kwargs):
+        opened.append(args)
+        return Repo.clone_from(origin, Path(tmp_path, "clone"))
+
+    origin = Path(tmp_path, "recordsearch.git")
+    repo = Repo.init(origin, initial_branch="main")
+    Path(origin, "README.md").write_text("# RecordSearch")
+    repo.index.add(["README.md"])
+    commit = repo.index.commit("First commit")
+    monkeypatch.setattr(git, "Repo", fake_repo)
+    context = crate.get_repo_context()
+    assert context.name == "recordsearch"
+    assert context.default_branch == "main"
+    assert context.head_commit == commit.hexsha
+    crate.get_repo_info()
+    crate.get_repo_link({})
+    assert len(opened) == 1
+
+
+def test_get_repo_info_no_remote(monkeypatch, crate, tmp_path):
+    def fake_repo(*args, **kwargs):
+        return Repo.init(tmp_path)
+
+    monkeypatch.setattr(git, "Repo", fake_repo)
+    assert crate.get_repo_info() == ("example-repo", "")
+
+
 def test_get_repo_info_exception(monkeypatch, crate, tmp_path):
     def fake_repo(*args, **kwargs):
         return Repo(tmp_path)
@@ -286,13 +726,13 @@ def test_get_gh_branch(monkeypatch, crate):
 
 
 def test_get_gh_file_url(monkeypatch, crate):
-    def fake_repo_info(*args, **kwargs):
-        return "recordsearch", "https://github.com/GLAM-Workbench/recordsearch"
+    def fake_repo_context(*args, **kwargs):
+        return RepoContext("recordsearch", "https://github.com/GLAM-Workbench/recordsearch", None, None)
 
     def fake_gh_branch(*args, **kwargs):
         return "master"
 
-    monkeypatch.setattr(crate, "get_repo_info", fake_repo_info)
+    monkeypatch.setattr(crate, "get_repo_context", fake_repo_context)
     monkeypatch.setattr(crate, "get_default_gh_branch", fake_gh_branch)
     url = crate.get_gh_file_url("data/A6119-items.csv")
     assert (
@@ -301,6 +741,18 @@ def test_get_gh_file_url(monkeypatch, crate):
     )
 
 
+def test_get_gh_file_url_local_branch(monkeypatch, crate):
+    def fake_gh_branch(*args, **kwargs):
+        raise AssertionError("The local default branch should be used")
+
+    crate.repo_context = RepoContext(
+        "recordsearch", "https://github.com/GLAM-Workbench/recordsearch/", "main", None
+    )
+    monkeypatch.setattr(crate, "get_default_gh_branch", fake_gh_branch)
+    url = crate.get_gh_file_url("data/A6119-items.csv")
+    assert url == "https://github.com/GLAM-Workbench/recordsearch/blob/main/data/A6119-items.csv"
+
+
 def test_file_in_repo(crate):
     crate.data_repo = "https://github.com/GLAM-Workbench/trove-newspapers-non-english"
     assert crate.file_in_repo(
@@ -308,6 +760,11 @@ def test_file_in_repo(crate):
             "url": "https://github.com/GLAM-Workbench/trove-newspapers-non-english/blob/main/newspapers_non_english.csv"
         }
     )
+    assert crate.data_repo_name == "GLAM-Workbench/trove-newspapers-non-english"
+    assert not crate.file_in_repo(
+        {"url": "https://github.com/GLAM-Workbench/trove-newspapers-non-english-2/blob/main/data.csv"}
+    )
+    assert not crate.file_in_repo({"localPath": "data.csv"})
 
 
 def test_add_files_web(monkeypatch, crate):
@@ -368,16 +825,86 @@ def test_get_gh_stats(monkeypatch, crate):
     assert stats["dateModified"] == "2024-11-02T00:00:00"
 
 
+def test_index_gh_files(monkeypatch, crate):
+    def fake_gh_repo(*args, **kwargs):
+        return GitHubTreeRepo(full_name_or_id="GLAM-Workbench/recordsearch")
+
+    def fake_commit_dates(full_name, branch, paths):
+        return {path: "2025-03-01T10:00:00+00:00" for path in paths}
+
+    url = "https://github.com/GLAM-Workbench/recordsearch/blob/master/data/A6119-items.csv"
+    monkeypatch.setattr(crate, "get_gh_repo", fake_gh_repo)
+    monkeypatch.setattr(crate, "get_gh_commit_dates", fake_commit_dates)
+    crate.gh_client = GenericClass()
+    crate.gh_authenticated = True
+    crate.index_gh_files([url])
+    assert list(crate.gh_file_stats) == [("GLAM-Workbench/recordsearch", "data/A6119-items.csv")]
+    stats = crate.get_web_file_stats(url)
+    assert stats["contentSize"] == 12000
+    assert stats["dateModified"] == "2025-03-01T10:00:00+00:00"
+
+
+def test_get_gh_commit_dates(crate):
+    requester = GraphQLRequester()
+    crate.gh_client = GenericClass()
+    crate.gh_client.requester = requester
+    crate.gh_authenticated = True
+    dates = crate.get_gh_commit_dates("GLAM-Workbench/recordsearch", "master", ["data/A6119-items.csv"])
+    assert dates == {"data/A6119-items.csv": "2025-03-01T10:00:00+00:00"}
+    assert 'path: "data/A6119-items.csv"' in requester.queries[0]
+
+
+def test_get_gh_commit_dates_unauthenticated(crate):
+    crate.gh_client = GenericClass()
+    assert crate.get_gh_commit_dates("GLAM-Workbench/recordsearch", "master", ["data/A6119-items.csv"]) == {}
+
+
 def test_get_web_stats(monkeypatch, crate):
     def fake_headers(*args, **kwargs):
         return PageHead
 
-    monkeypatch.setattr(requests, "head", fake_headers)
+    monkeypatch.setattr(requests.Session, "head", fake_headers)
     stats = crate.get_web_file_stats("https://fake.url")
     assert list(stats.keys()) == ["sdDatePublished", "contentSize", "dateModified"]
     assert stats["dateModified"] == "2024-09-13T07:01:28+00:00"
 
 
+def test_cache_resolver(monkeypatch, crate, tmp_path):
+    def no_network(*args, **kwargs):
+        raise requests.exceptions.ConnectionError()
+
+    # Stale records are still used offline
+    cache = MetadataCache(Path(tmp_path, "cache.sqlite"), ttl=0)
+    cache.set("https://glam-workbench.net/", title="GLAM Workbench")
+    cache.set("https://fake.url", "head", content_length=23000, last_modified="Fri, 13 Sep 2024 07:01:28 GMT")
+    cache.set_default_branch("GLAM-Workbench/recordsearch", "master")
+    crate.resolver = CacheResolver(cache)
+    monkeypatch.setattr(requests.Session, "get", no_network)
+    monkeypatch.setattr(requests.Session, "head", no_network)
+    monkeypatch.setattr(Github, "get_repo", no_network)
+    assert crate.get_page_title("https://glam-workbench.net/") == "GLAM Workbench"
+    stats = crate.get_web_file_stats("https://fake.url")
+    assert stats["contentSize"] == 23000
+    assert stats["dateModified"] == "2024-09-13T07:01:28+00:00"
+    assert crate.get_default_gh_branch("https://github.com/GLAM-Workbench/recordsearch") == "master"
+    assert crate.unresolved == {}
+
+
+def test_fixture_resolver_missing(crate, tmp_path):
+    fixtures = Path(tmp_path, "fixtures.json")
+    fixtures.write_text(json.dumps({"titles": {"https://glam-workbench.net/": "GLAM Workbench"}}))
+    crate.resolver = FixtureResolver(fixtures)
+    assert crate.get_page_title("https://glam-workbench.net/") == "GLAM Workbench"
+    assert crate.get_page_title("https://timsherratt.au") is None
+    assert crate.get_web_file_stats("https://fake.url") == {}
+    assert crate.get_default_gh_branch("https://github.com/GLAM-Workbench/recordsearch") == "HEAD"
+    assert crate.unresolved == {
+        "https://timsherratt.au": {"title"},
+        "https://fake.url": {"file stats"},
+        "https://github.com/GLAM-Workbench/recordsearch": {"default branch"},
+    }
+
+
 def test_get_local_file_stats(crate, data_file):
     file_path = Path("test.csv")
     data_file.to_csv(file_path)
@@ -393,6 +920,95 @@ def test_get_local_file_stats(crate, data_file):
     file_path.unlink()
 
 
+def test_count_lines(tmp_path):
+    file_path = Path(tmp_path, "test.ndjson")
+    file_path.write_bytes(b'{"a": 1}\n{"a": 2}\r\n{"a": 3}')
+    assert count_lines(file_path) == 3
+    file_path.write_bytes(b"")
+    assert count_lines(file_path) == 0
+
+
+def test_count_csv_records(tmp_path, data_file):
+    data_file.loc[0, "name"] = "Bob\nthe \"Builder\""
+    file_path = Path(tmp_path, "test.csv")
+    data_file.to_csv(file_path)
+    assert count_lines(file_path) == data_file.shape[0] + 2
+    assert count_csv_records(file_path) == data_file.shape[0] + 1
+
+
+def test_count_csv_records_chunked(monkeypatch, tmp_path):
+    monkeypatch.setattr(update_crate, "ROW_COUNT_CHUNK", 3)
+    file_path = Path(tmp_path, "test.csv")
+    file_path.write_bytes(b'a,b\n"x\ny",1\n"""q""\n",2')
+    assert count_csv_records(file_path) == 3
+
+
+def test_count_rows_cached(monkeypatch, crate, cache, tmp_path, data_file):
+    file_path = Path(tmp_path, "test.csv")
+    data_file.to_csv(file_path)
+    crate.cache = cache
+    crate.get_local_file_stats(file_path)
+
+    def fail_count(*args, **kwargs):
+        raise AssertionError("Unchanged files shouldn't be recounted")
+
+    monkeypatch.setattr(update_crate, "count_lines", fail_count)
+    crate.row_counts = {}
+    stats = crate.get_local_file_stats(file_path)
+    assert stats["size"] == data_file.shape[0] + 1
+
+
+def test_resolve_local_files(monkeypatch, crate, tmp_path, data_file):
+    paths = []
+    for index in range(3):
+        paths.append(str(Path(tmp_path, f"test{index}.csv")))
+        data_file.iloc[: index + 1].to_csv(paths[-1])
+    crate.checksums = ["sha256"]
+    crate.resolve_local_files(paths + [str(Path(tmp_path, "missing.csv"))])
+
+    def fail_stats(*args, **kwargs):
+        raise AssertionError("Stats should have been resolved")
+
+    monkeypatch.setattr(crate, "read_local_file_stats", fail_stats)
+    assert [crate.get_local_file_stats(path)["size"] for path in paths] == [2, 3, 4]
+    assert crate.get_local_file_stats(paths[0])["sha256"] == hashlib.sha256(Path(paths[0]).read_bytes()).hexdigest()
+    assert str(Path(tmp_path, "missing.csv")) not in crate.local_file_stats
+
+
+def test_hash_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(update_crate, "HASH_CHUNK", 3)
+    file_path = Path(tmp_path, "test.csv")
+    file_path.write_bytes(b"id,name\n1,Bob\n")
+    assert hash_file(file_path, ["sha256", "md5"]) == {
+        "sha256": hashlib.sha256(b"id,name\n1,Bob\n").hexdigest(),
+        "md5": hashlib.md5(b"id,name\n1,Bob\n").hexdigest(),
+    }
+    file_path.write_bytes(b"")
+    assert hash_file(file_path, ["sha256"]) == {"sha256": hashlib.sha256().hexdigest()}
+
+
+def test_hash_file_xxhash(monkeypatch, tmp_path):
+    monkeypatch.setattr(update_crate, "xxhash", None)
+    with pytest.raises(ValueError):
+        hash_file(Path(tmp_path, "test.csv"), ["xxh3_64"])
+
+
+def test_get_checksums_cached(monkeypatch, crate, cache, tmp_path):
+    file_path = Path(tmp_path, "test.ndjson")
+    file_path.write_text('{"a": 1}\n')
+    crate.cache = cache
+    crate.checksums = ["sha256"]
+    stats = crate.get_local_file_stats(file_path)
+    assert stats["sha256"] == hashlib.sha256(b'{"a": 1}\n').hexdigest()
+
+    def fail_hash(*args, **kwargs):
+        raise AssertionError("Unchanged files shouldn't be hashed again")
+
+    monkeypatch.setattr(update_crate, "hash_file", fail_hash)
+    crate.file_checksums = {}
+    assert crate.get_local_file_stats(file_path)["sha256"] == stats["sha256"]
+
+
 def test_get_local_dir_stats(crate, data_file):
     test_dir = Path("test-data")
     test_dir.mkdir()
@@ -403,6 +1019,42 @@ def test_get_local_dir_stats(crate, data_file):
     shutil.rmtree("test-data")
 
 
+def test_get_local_dir_stats_recursive(monkeypatch, crate, cache, tmp_path):
+    Path(tmp_path, "images", "1842").mkdir(parents=True)
+    Path(tmp_path, "images", "1842", "page1.jpg").write_bytes(b"1" * 100)
+    Path(tmp_path, "images", "1842", "page2.JPG").write_bytes(b"2" * 100)
+    Path(tmp_path, "images", "index.csv").write_text("id\n1\n2\n")
+    crate.cache = cache
+    crate.recursive_dir_stats = True
+    stats = crate.get_local_file_stats(Path(tmp_path, "images"))
+    assert stats["size"] == 3
+    assert stats["contentSize"] == 207
+    assert stats["encodingFormat"] == ["image/jpeg", "text/csv"]
+    # Changes in subdirectories don't change the directory's modification time,
+    # so recursive stats are only remembered for the run
+    Path(tmp_path, "images", "1842", "page3.jpg").write_bytes(b"3" * 1000)
+    crate.local_file_stats = {}
+    crate.dir_stats = {}
+    stats = crate.get_local_file_stats(Path(tmp_path, "images"))
+    assert stats["size"] == 4
+    assert stats["contentSize"] == 1207
+
+
+def test_get_local_dir_stats_cached(monkeypatch, crate, cache, tmp_path):
+    Path(tmp_path, "images").mkdir()
+    Path(tmp_path, "images", "page1.jpg").write_bytes(b"1" * 100)
+    crate.cache = cache
+    assert crate.get_local_file_stats(Path(tmp_path, "images"))["size"] == 1
+
+    def fail_scan(*args, **kwargs):
+        raise AssertionError("Unchanged directories shouldn't be rescanned")
+
+    monkeypatch.setattr(update_crate, "scan_dir", fail_scan)
+    crate.local_file_stats = {}
+    crate.dir_stats = {}
+    assert crate.get_local_file_stats(Path(tmp_path, "images"))["size"] == 1
+
+
 def test_update_properties(monkeypatch, crate):
     def fake_add_entities(entry, key, value):
         entry[key] = delistify(value)
@@ -451,6 +1103,40 @@ def test_add_people_orcid_str(crate):
     assert crate.crate.get(added[0].id) != None
 
 
+def test_entity_index(crate):
+    author = {"name": "Sherratt, Tim", "orcid": "0000-0001-7956-4498"}
+    crate.add_people([author])
+    page = crate.add_page({"url": "https://glam-workbench.net/", "name": "GLAM Workbench", "author": [author]})
+    index = crate.get_entity_index()
+    assert index.get("https://orcid.org/0000-0001-7956-4498")["name"] == "Sherratt, Tim"
+    # Ids are resolved as the crate resolves them
+    assert index.get("https://glam-workbench.net") is page
+    assert index.get_by_type("CreativeWork") == crate.crate.get_by_type("CreativeWork")
+    assert index.get_by_type("Person") == crate.crate.get_by_type("Person")
+    assert index.get_referrers("https://orcid.org/0000-0001-7956-4498", type_="CreativeWork") == [page]
+    assert index.get_referrers("https://orcid.org/0000-0001-7956-4498", type_="Person") == []
+    # Replacing an entity drops its old references
+    crate.add_context_entity({"@id": "https://glam-workbench.net/", "@type": "WebPage"})
+    assert index.get_referrers("https://orcid.org/0000-0001-7956-4498") == []
+    assert index.get_by_type("WebPage") == [crate.crate.get("https://glam-workbench.net/")]
+    assert page not in index.get_by_type("CreativeWork")
+    # A new crate gets a new index
+    crate.crate = ROCrate()
+    assert crate.get_entity("https://glam-workbench.net/") is None
+
+
+def test_merge_authors(crate):
+    tim, kate, bill = crate.add_people(
+        [
+            {"name": "Sherratt, Tim", "orcid": "0000-0001-7956-4498"},
+            {"name": "Bagnall, Kate"},
+            {"name": "Smith, Bill"},
+        ]
+    )
+    merged = crate.merge_authors(tim, [kate, tim], None, [bill, kate])
+    assert [author.id for author in merged] == [tim.id, kate.id, bill.id]
+
+
 def test_add_update_action(crate):
     crate.add_update_action("v1.0")
     version = crate.crate.get("create_version_v1_0")
@@ -511,11 +1197,31 @@ def test_add_pages(crate):
     assert crate.crate.get(page_data[0]["url"]) != None
 
 
+def test_add_page_named(monkeypatch, crate):
+    def mock_get(*args, **kwargs):
+        raise AssertionError("Pages with names shouldn't be requested")
+
+    monkeypatch.setattr(requests.Session, "get", mock_get)
+    crate.old_graph = {"https://timsherratt.au": {"@id": "https://timsherratt.au", "name": "Tim's page"}}
+    crate.add_page({"url": "https://glam-workbench.net/", "name": "GLAM Workbench"})
+    assert crate.add_page("https://glam-workbench.net/")["name"] == "GLAM Workbench"
+    assert crate.add_page("https://timsherratt.au")["name"] == "Tim's page"
+    assert crate.named_pages == {"https://glam-workbench.net/", "https://timsherratt.au"}
+    pages = set()
+    crate.collect_urls(
+        {"mainEntityOfPage": ["https://timsherratt.au", "https://mycoolsite.com"],
+         "isBasedOn": {"url": "https://glam-workbench.net/", "name": "GLAM Workbench"}},
+        pages,
+        set(),
+    )
+    assert pages == {"https://mycoolsite.com"}
+
+
 def test_add_licence(crate):
     licences = ["mit"]
     added = crate.add_licence(licences)
-    assert crate.crate.get(LICENCES[licences[0]]["@id"]) != None
-    assert added[0].id == LICENCES[licences[0]]["@id"]
+    assert crate.crate.get(load_licences()[licences[0]]["@id"]) != None
+    assert added[0].id == load_licences()[licences[0]]["@id"]
 
 
 def test_add_download(crate):
@@ -580,8 +1286,175 @@ def test_get_old_crate_data(crate, crate_path):
     root_props, entities, versions = crate.get_old_crate_data(crate_path)
     assert root_props["name"] == "My ROCrate"
     assert "mainEntityOfPage" in entities
-    assert entities.get("mainEntityOfPage").id == "https://glam-workbench.net/trove-newspapers/"
-    assert versions[0].id == "create_version_v_1_0"
+    assert entities.get("mainEntityOfPage")["@id"] == "https://glam-workbench.net/trove-newspapers/"
+    assert versions[0]["@id"] == "create_version_v_1_0"
+
+
+def test_get_old_crate_data_json(monkeypatch, crate, crate_path):
+    monkeypatch.setattr(update_crate, "orjson", None)
+    root_props, entities, versions = crate.get_old_crate_data(crate_path)
+    assert root_props["name"] == "My ROCrate"
+    assert [version["@id"] for version in versions] == ["create_version_v_1_0"]
+
+
+def test_get_old_crate_data_missing(crate, tmp_path):
+    assert crate.get_old_crate_data(tmp_path) == ({}, {}, [])
+
+
+def test_write_crate(crate, crate_path, tmp_path):
+    crate.crate = ROCrate(crate_path)
+    crate.add_people([{"name": "Sherratt, Tim", "orcid": "0000-0001-7956-4498", "description": "Über"}])
+    crate.write_crate(tmp_path)
+    expected = json.dumps(crate.crate.metadata.generate(), indent=4, sort_keys=True, ensure_ascii=False)
+    assert Path(tmp_path, "ro-crate-metadata.json").read_text() == expected
+
+
+def test_write_crate_checksum_terms(crate, tmp_path):
+    crate.checksums = ["sha256", "xxh3_64"]
+    crate.write_crate(tmp_path)
+    context = json.loads(Path(tmp_path, "ro-crate-metadata.json").read_text())["@context"]
+    assert context[1] == {"xxh3_64": "https://glam-workbench.net/terms#xxh3_64"}
+
+
+def test_write_crate_unchanged(crate, tmp_path):
+    crate.reproducible = True
+    crate.add_people([{"name": "Sherratt, Tim"}, {"name": "Bagnall, Kate"}])
+    assert crate.write_crate(tmp_path)
+    old_graph = crate.load_crate_graph(tmp_path)
+    assert [entity["@id"] for entity in old_graph.values()] == [
+        "./", "ro-crate-metadata.json", "#Bagnall_Kate", "#Sherratt_Tim"
+    ]
+    crate.crate = ROCrate()
+    crate.add_people([{"name": "Bagnall, Kate"}, {"name": "Sherratt, Tim"}])
+    crate.carry_over_timestamps(old_graph)
+    assert not crate.write_crate(tmp_path)
+
+
+def test_carry_over_timestamps(crate):
+    props = {"@type": ["File", "Dataset"], "contentSize": 23000, "sdDatePublished": "2025-06-13"}
+    old_graph = {
+        "unchanged.csv": {"@id": "unchanged.csv", **props},
+        "changed.csv": {"@id": "changed.csv", **props},
+    }
+    unchanged = crate.crate.add_file("unchanged.csv", properties={**props, "sdDatePublished": "2026-10-17"})
+    changed = crate.crate.add_file(
+        "changed.csv", properties={**props, "contentSize": 24000, "sdDatePublished": "2026-10-17"}
+    )
+    crate.carry_over_timestamps(old_graph)
+    assert unchanged["sdDatePublished"] == "2025-06-13"
+    assert changed["sdDatePublished"] == "2026-10-17"
+
+
+def test_write_crate_interrupted(monkeypatch, crate, crate_path):
+    def interrupted(metadata, entities=None):
+        yield "{"
+        raise KeyboardInterrupt()
+
+    original = Path(crate_path, "ro-crate-metadata.json").read_text()
+    crate.crate = ROCrate(crate_path)
+    monkeypatch.setattr(update_crate, "stream_jsonld", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        crate.write_crate(crate_path)
+    assert Path(crate_path, "ro-crate-metadata.json").read_text() == original
+    assert [path.name for path in crate_path.iterdir()] == ["ro-crate-metadata.json"]
+
+
+@pytest.fixture
+def old_graph():
+    return {
+        "./": {"@id": "./", "@type": "Dataset", "hasPart": [{"@id": "test_nb.ipynb"}]},
+        "test_nb.ipynb": {
+            "@id": "test_nb.ipynb",
+            "@type": ["File", "SoftwareSourceCode"],
+            "name": "My test notebook",
+            "author": {"@id": "#Sherratt_Tim"},
+            "isPartOf": {"@id": "./"},
+        },
+        "#Sherratt_Tim": {"@id": "#Sherratt_Tim", "@type": "Person", "name": "Sherratt, Tim"},
+        "#test_nb_run_0": {
+            "@id": "#test_nb_run_0",
+            "@type": "CreateAction",
+            "instrument": {"@id": "test_nb.ipynb"},
+            "result": {"@id": "https://glam-workbench.net/data.csv"},
+            "actionStatus": {"@id": "http://schema.org/CompletedActionStatus"},
+        },
+        "https://glam-workbench.net/data.csv": {
+            "@id": "https://glam-workbench.net/data.csv",
+            "@type": ["File", "Dataset"],
+            "contentSize": 2456,
+        },
+        "#unrelated": {"@id": "#unrelated", "@type": "Thing"},
+    }
+
+
+def test_fingerprint(tmp_path):
+    file_path = Path(tmp_path, "test.csv")
+    file_path.write_text("a,b\n")
+    assert fingerprint(file_path)[0] == 4
+    assert fingerprint(Path(tmp_path, "missing.csv")) is None
+
+
+def test_fingerprint_recursive(tmp_path):
+    Path(tmp_path, "images", "1842").mkdir(parents=True)
+    Path(tmp_path, "images", "1842", "page1.jpg").write_bytes(b"1" * 100)
+    before = fingerprint(Path(tmp_path, "images"), recursive=True)
+    assert before[0] == 100
+    Path(tmp_path, "images", "1842", "page2.jpg").write_bytes(b"2" * 100)
+    assert fingerprint(Path(tmp_path, "images"), recursive=True) != before
+
+
+def test_is_unchanged(crate, nb_path, old_graph):
+    notebook = Path(nb_path, "test_nb.ipynb")
+    entry = crate.fingerprint_notebook(notebook, "test_nb.ipynb")
+    assert crate.is_unchanged(notebook, entry, old_graph)
+    # A fresh clone changes modification times, but not contents
+    os.utime(notebook, (0, 0))
+    assert crate.is_unchanged(notebook, entry, old_graph)
+    notebook.write_text(notebook.read_text() + "\n")
+    assert not crate.is_unchanged(notebook, entry, old_graph)
+    assert not crate.is_unchanged(notebook, None, old_graph)
+
+
+def test_load_manifest(crate, tmp_path):
+    crate.defaults = {"name": "My crate"}
+    crate.write_manifest(tmp_path, {"test_nb.ipynb": {"id": "test_nb.ipynb"}})
+    assert "test_nb.ipynb" in crate.load_manifest(tmp_path)
+    crate.defaults = {"name": "My changed crate"}
+    assert crate.load_manifest(tmp_path) == {}
+
+
+def test_load_manifest_fresh_clone(monkeypatch, crate, tmp_path):
+    script = Path(tmp_path, "update_crate.py")
+    shutil.copy(update_crate.__file__, script)
+    monkeypatch.setattr(update_crate, "__file__", str(script))
+    crate.write_manifest(tmp_path, {"test_nb.ipynb": {"id": "test_nb.ipynb"}})
+    # The script is fingerprinted by its contents, not its modification time
+    os.utime(script, (0, 0))
+    assert "test_nb.ipynb" in crate.load_manifest(tmp_path)
+    script.write_text(script.read_text() + "\n")
+    assert crate.load_manifest(tmp_path) == {}
+
+
+def test_get_references(crate, old_graph):
+    references = crate.get_references(["test_nb.ipynb", "#test_nb_run_0"], old_graph)
+    assert references == [
+        "test_nb.ipynb",
+        "#test_nb_run_0",
+        "#Sherratt_Tim",
+        "https://glam-workbench.net/data.csv",
+    ]
+
+
+def test_carry_over_notebook(crate, old_graph, tmp_path):
+    crate.crate.add(Person(crate.crate, "#Sherratt_Tim", properties={"name": "Tim"}))
+    nb = crate.carry_over_notebook(
+        "test_nb.ipynb", old_graph, {"test_nb.ipynb": ["#test_nb_run_0"]}, tmp_path
+    )
+    assert nb["name"] == "My test notebook"
+    assert crate.crate.get("#Sherratt_Tim")["name"] == "Sherratt, Tim"
+    assert crate.crate.get("https://glam-workbench.net/data.csv")["contentSize"] == 2456
+    assert crate.crate.get("#unrelated") is None
+    assert crate.crate.root_dataset["mentions"][0].id == "#test_nb_run_0"
 
 
 @pytest.fixture
@@ -616,3 +1489,70 @@ def test_prepare_data_crate(monkeypatch, crate):
     root_props, crate_source, entities, versions = crate.prepare_data_crate()
     assert root_props["name"] == "trove-newspapers-non-english"
     assert crate_source == "./trove-newspapers-non-english-rocrate"
+
+
+def test_read_repo_list(tmp_path):
+    manifest = Path(tmp_path, "repos.txt")
+    manifest.write_text(
+        "# GLAM Workbench repos\n"
+        "trove-newspapers\n"
+        "\n"
+        "trove-newspapers-data https://github.com/GLAM-Workbench/trove-newspapers-non-english\n"
+    )
+    # Relative directories are resolved against the manifest, not the working directory
+    manifest_dir = tmp_path.resolve()
+    assert batch_update.read_repo_list(manifest) == [
+        (str(Path(manifest_dir, "trove-newspapers")), ""),
+        (
+            str(Path(manifest_dir, "trove-newspapers-data")),
+            "https://github.com/GLAM-Workbench/trove-newspapers-non-english",
+        ),
+    ]
+
+
+def test_update_repo(monkeypatch, tmp_path):
+    updated = []
+
+    def fake_update_crate(self):
+        updated.append((Path.cwd(), self.defaults, self.data_repo))
+        if self.data_repo:
+            raise ValueError("Couldn't update crate")
+
+    monkeypatch.chdir(Path.cwd())
+    monkeypatch.setattr(CrateMaker, "update_crate", fake_update_crate)
+    monkeypatch.setattr(batch_update, "WORKER_STATE", {})
+    Path(tmp_path, "defaults.json").write_text(json.dumps({"name": "My crate"}))
+    options = {
+        "defaults_file": "defaults.json",
+        "use_cache": False,
+        "csv_records": False,
+        "incremental": False,
+        "offline": False,
+        "recursive_dir_stats": False,
+        "checksums": None,
+        "reproducible": False,
+    }
+    result = batch_update.update_repo((str(tmp_path), "", options))
+    assert result["ok"]
+    assert updated[0] == (tmp_path.resolve(), {"name": "My crate"}, "")
+    result = batch_update.update_repo((str(tmp_path), "https://github.com/GLAM-Workbench/trove-newspapers-non-english", options))
+    assert not result["ok"]
+    assert "Couldn't update crate" in result["error"]
+
+
+def test_update_relative_repos(monkeypatch, tmp_path):
+    updated = []
+
+    def fake_update_crate(self):
+        updated.append(Path.cwd())
+
+    # A single worker thread shares the working directory, like a single worker process
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(CrateMaker, "update_crate", fake_update_crate)
+    monkeypatch.setattr(batch_update, "WORKER_STATE", {})
+    monkeypatch.setattr(batch_update, "ProcessPoolExecutor", ThreadPoolExecutor)
+    Path(tmp_path, "a").mkdir()
+    Path(tmp_path, "b").mkdir()
+    results = batch_update.main([("a", ""), ("b", "")], workers=1, use_cache=False)
+    assert all(result["ok"] for result in results)
+    assert updated == [Path(tmp_path, "a").resolve(), Path(tmp_path, "b").resolve()]
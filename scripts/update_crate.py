@@ -1,24 +1,45 @@
 import os
 from pathlib import Path
-from rocrate.rocrate import ROCrate
-from rocrate.model.person import Person
-from rocrate.model.data_entity import DataEntity
-from rocrate.model.contextentity import ContextEntity
-from git import Repo
-from git.exc import InvalidGitRepositoryError, GitCommandError
 import json
 import argparse
 import datetime
-import nbformat
 import sys
-import requests
-from bs4 import BeautifulSoup
-from github import Github
 import re
-import arrow
-import git
+import copy
+import filecmp
+import contextlib
+import functools
+import hashlib
+import codecs
+import mimetypes
+import mmap
+import sqlite3
+import tempfile
+import time
+import threading
+from urllib.parse import urlparse
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, namedtuple
+
+# Heavy dependencies (rocrate, GitPython, PyGithub, requests, arrow)
+# are imported where they're used, so that they're only loaded when they're needed.
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
-LICENCES = json.loads(Path("scripts", "licences.json").read_text())
 CONTEXT_PROPERTIES = [
     "author",
     "action",
@@ -30,14 +51,127 @@ CONTEXT_PROPERTIES = [
     "isPartOf",
     "license"
 ]
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"), "glam-workbench")
+# Cached values are used without revalidation for a day, and discarded after a month
+CACHE_TTL = 24 * 60 * 60
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# Limits on simultaneous requests when resolving urls before the crate is built
+MAX_WORKERS = 16
+MAX_WORKERS_PER_HOST = 4
+# Seconds to wait for a connection or a response
+HTTP_TIMEOUT = 30
+# Failed connections and 429/5xx responses are retried, waiting 0.5s, 1s, 2s...
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+# Requests per second to any one host, allowing bursts of up to twice as many
+HOST_RATE = 10
+# Bytes of a page read while looking for its <title>, and read at a time
+TITLE_MAX_BYTES = 256 * 1024
+TITLE_CHUNK = 16 * 1024
+GH_API_URL = "https://api.github.com"
+# Number of file histories requested in each GitHub GraphQL query
+GH_GRAPHQL_BATCH = 100
+# Bytes read at a time when counting rows in data files
+ROW_COUNT_CHUNK = 1024 * 1024
+# Bytes hashed at a time when calculating checksums of data files
+HASH_CHUNK = 8 * 1024 * 1024
+# Checksum properties other than sha256 aren't in the RO-Crate context, so they're
+# declared as extra terms in this namespace
+CONTEXT_CHECKSUMS = ["sha256"]
+CHECKSUM_TERMS = "https://glam-workbench.net/terms#"
+# Sidecar file recording the inputs used to generate each notebook's entities
+MANIFEST_NAME = ".ro-crate-manifest.json"
+
+# Properties set from the time a crate is generated rather than from its inputs, by entity type
+TIMESTAMP_PROPERTIES = {
+    "Dataset": ["datePublished"],
+    "File": ["sdDatePublished"],
+    "UpdateAction": ["endDate"],
+}
+
+# Details of the local git repository, read once per run
+RepoContext = namedtuple("RepoContext", ["name", "url", "default_branch", "head_commit"])
+
+# Urls of GitHub repositories, and of files and folders in them (on github.com or raw.githubusercontent.com)
+GH_URL_PATTERN = re.compile(
+    r"https?://(?P<host>(?:[\w-]+\.)*(?:github|githubusercontent)\.com)/(?P<owner>[\w.-]+)/"
+    r"(?P<repo>[\w.-]+?)(?:\.git)?(?:/(?P<rest>[^?#]*))?(?:[?#].*)?$"
+)
+
+
+class GitHubUrl(namedtuple("GitHubUrl", ["owner", "repo", "ref", "path", "kind"])):
+    """
+    The parts of a GitHub url. The kind is "repo" for a url of a repository, "blob", "tree"
+    or "raw" for files and folders, or the first part of the path for any other page.
+    """
+
+    __slots__ = ()
+
+    @property
+    def full_name(self):
+        return f"{self.owner}/{self.repo}"
+
+
+@functools.cache
+def load_licences():
+    """
+    Load the licence entities, keyed by short name.
+    """
+    return json.loads(Path(__file__).resolve().parent.joinpath("licences.json").read_text())
 
 
-def main(crate_path, defaults, version, data_repo):
-    # Make working directory the parent of the scripts directory
-    os.chdir(Path(__file__).resolve().parent.parent)
-    crate_maker = CrateMaker(crate_path, defaults=defaults, version=version, data_repo=data_repo)
+def main(
+    crate_path,
+    defaults,
+    version,
+    data_repo,
+    use_cache=True,
+    csv_records=False,
+    incremental=False,
+    recursive_dir_stats=False,
+    checksums=None,
+    reproducible=False,
+    timeout=HTTP_TIMEOUT,
+    host_rate=HOST_RATE,
+    profile=None,
+    trace=None,
+    offline=False,
+    fixtures=None,
+):
+    cache = MetadataCache() if use_cache or (offline and not fixtures) else None
+    profiler = Profiler()
+    # Output paths are relative to where the script was run, not the repository
+    profile = Path(profile).resolve() if profile else None
+    trace = Path(trace).resolve() if trace else None
+    if fixtures:
+        resolver = FixtureResolver(Path(fixtures).resolve())
+    elif offline:
+        resolver = CacheResolver(cache)
+    else:
+        resolver = None
+    crate_maker = CrateMaker(
+        crate_path,
+        defaults=defaults,
+        version=version,
+        data_repo=data_repo,
+        cache=cache,
+        csv_records=csv_records,
+        incremental=incremental,
+        recursive_dir_stats=recursive_dir_stats,
+        checksums=checksums,
+        reproducible=reproducible,
+        timeout=timeout,
+        host_rate=host_rate,
+        profiler=profiler,
+        resolver=resolver,
+    )
     # Update the crate
     crate_maker.update_crate()
+    if profile:
+        profiler.write(profile)
+        print(profiler.summary())
+    if trace:
+        profiler.write_spans(trace)
 
 
 def listify(value):
@@ -53,15 +187,919 @@ def delistify(value):
         return value
 
 
+def http_date_to_iso(value):
+    """
+    Convert a date from an HTTP header to an ISO formatted string.
+    """
+    import arrow
+
+    return arrow.get(value, "ddd, D MMM YYYY HH:mm:ss ZZZ").isoformat()
+
+
+class TitleParser(HTMLParser):
+    """
+    Collects the text of the first <title> element fed to it, noting when it's complete.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.in_title = False
+        self.done = False
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title" and not self.done:
+            self.in_title = True
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.in_title:
+            self.in_title = False
+            self.done = True
+        elif tag in ["head", "body"]:
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.parts.append(data)
+
+    @property
+    def title(self):
+        return "".join(self.parts).strip() or None
+
+
+def parse_content_type(value):
+    """
+    Split a Content-Type header into the media type and charset (if any).
+    """
+    media_type, *params = (value or "").split(";")
+    charset = None
+    for param in params:
+        name, _, param_value = param.partition("=")
+        if name.strip().lower() == "charset":
+            charset = param_value.strip().strip('"') or None
+    return media_type.strip().lower(), charset
+
+
+def read_title(response, max_bytes=TITLE_MAX_BYTES):
+    """
+    Read the title of an HTML page from a streamed response, stopping once the
+    title is complete, or after max_bytes. Responses that aren't HTML aren't read.
+
+    Returns:
+        The title, or None if there isn't one
+    """
+    try:
+        media_type, charset = parse_content_type(response.headers.get("Content-Type"))
+        if media_type not in ["text/html", "application/xhtml+xml", ""]:
+            return None
+        # Requests assumes ISO-8859-1 for text without a charset, but most pages are UTF-8
+        try:
+            decoder = codecs.getincrementaldecoder(charset or "utf-8")(errors="replace")
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        parser = TitleParser()
+        read = 0
+        for chunk in response.iter_content(chunk_size=TITLE_CHUNK):
+            parser.feed(decoder.decode(chunk))
+            read += len(chunk)
+            if parser.done or read >= max_bytes:
+                break
+        parser.close()
+        return parser.title
+    finally:
+        response.close()
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_gh_url(url):
+    """
+    Split a GitHub url into its owner, repository, ref, and path.
+    Refs are assumed not to contain slashes, unless they're given in full (refs/heads/...).
+
+    Returns:
+        A GitHubUrl, or None if it's not a GitHub url
+    """
+    match = GH_URL_PATTERN.match(url or "")
+    if not match:
+        return None
+    segments = [segment for segment in (match["rest"] or "").split("/") if segment]
+    if match["host"] == "raw.githubusercontent.com":
+        kind = "raw"
+    elif not segments:
+        return GitHubUrl(match["owner"], match["repo"], None, None, "repo")
+    else:
+        kind = segments.pop(0)
+    ref = None
+    if kind in ["blob", "tree", "raw"] and segments:
+        if segments[0] == "refs" and len(segments) > 2:
+            segments = segments[2:]
+        ref = segments.pop(0)
+    return GitHubUrl(match["owner"], match["repo"], ref, "/".join(segments) or None, kind)
+
+
+@contextlib.contextmanager
+def atomic_write(path, keep_unchanged=False):
+    """
+    Open a temporary file that replaces the file at path once it's been written.
+    If writing fails the file at path is left as it was. If keep_unchanged is True
+    and the new content is the same as the old, the old file isn't touched.
+    """
+    path = Path(path)
+    mode = path.stat().st_mode if path.exists() else 0o644
+    temp_file = tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=path.parent, prefix=f".{path.name}.", delete=False
+    )
+    try:
+        with temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if keep_unchanged and path.exists() and filecmp.cmp(temp_file.name, path, shallow=False):
+            Path(temp_file.name).unlink()
+            return
+        os.chmod(temp_file.name, mode)
+        os.replace(temp_file.name, path)
+    except BaseException:
+        Path(temp_file.name).unlink(missing_ok=True)
+        raise
+
+
+def stream_jsonld(metadata, entities=None):
+    """
+    Serialise a crate's metadata one entity at a time, in the same format
+    as rocrate's Metadata.generate, without building the whole graph in memory.
+    Entities are written in the order they were added to the crate, unless
+    a list of entities is supplied.
+    """
+    def dumps(value, indent):
+        return json.dumps(value, indent=4, sort_keys=True, ensure_ascii=False).replace(
+            "\n", "\n" + " " * indent
+        )
+
+    context = [f"{metadata.profile}/context"] + metadata.extra_contexts
+    if metadata.extra_terms:
+        context.append(metadata.extra_terms)
+    if len(context) == 1:
+        context = context[0]
+    yield f'{{\n    "@context": {dumps(context, 4)},\n    "@graph": ['
+    separator = "\n"
+    for entity in entities if entities is not None else metadata.crate.get_entities():
+        yield f"{separator}        {dumps(entity.properties(), 8)}"
+        separator = ",\n"
+    yield "\n    ]\n}"
+
+
+def fingerprint(path, recursive=False):
+    """
+    A cheap fingerprint of a file: its size and modification time.
+    If recursive is True, directories are fingerprinted by the sizes and modification
+    times of everything in them, as their own modification time only changes when
+    their entries do. Returns None if the file doesn't exist.
+    """
+    try:
+        file_stats = Path(path).stat()
+    except FileNotFoundError:
+        return None
+    if recursive and Path(path).is_dir():
+        digest = hashlib.sha256()
+        size = 0
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            digest.update(f"{root}\0{os.stat(root).st_mtime_ns}\n".encode())
+            for name in sorted(files):
+                entry_stats = os.stat(os.path.join(root, name), follow_symlinks=False)
+                size += entry_stats.st_size
+                digest.update(f"{name}\0{entry_stats.st_size}\0{entry_stats.st_mtime_ns}\n".encode())
+        return [size, digest.hexdigest()]
+    return [file_stats.st_size, file_stats.st_mtime_ns]
+
+
+def count_lines(path):
+    """
+    Count the lines in a file by counting newlines in binary chunks, without decoding it.
+    A final line without a trailing newline is included.
+    """
+    lines = 0
+    last = b"\n"
+    with open(path, "rb") as data_file:
+        while chunk := data_file.read(ROW_COUNT_CHUNK):
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    if last != b"\n":
+        lines += 1
+    return lines
+
+
+def count_csv_records(path):
+    """
+    Count the records in a CSV file, ignoring newlines inside quoted fields.
+    Splitting a chunk on quote characters gives segments that are alternately outside
+    and inside quoted fields, so only newlines in the outside segments are counted.
+    Escaped quotes ("") close and reopen a field, so they don't change the count.
+    """
+    records = 0
+    quoted = False
+    last = b"\n"
+    with open(path, "rb") as data_file:
+        while chunk := data_file.read(ROW_COUNT_CHUNK):
+            segments = chunk.split(b'"')
+            records += sum(segment.count(b"\n") for segment in segments[quoted::2])
+            # An odd number of quotes in the chunk flips whether we're inside a field
+            quoted ^= len(segments) % 2 == 0
+            last = chunk[-1:]
+    if last != b"\n" and not quoted:
+        records += 1
+    return records
+
+
+def count_file_rows(path, csv_records=False):
+    """
+    Count the rows in a data file, as CSV records or as lines.
+    """
+    return count_csv_records(path) if csv_records else count_lines(path)
+
+
+def new_hash(algorithm):
+    """
+    Create a hash object for one of hashlib's algorithms, or one of xxhash's
+    (eg xxh3_64) if it's installed.
+    """
+    if algorithm.startswith("xxh"):
+        if not xxhash:
+            raise ValueError(f"{algorithm} checksums need the xxhash package")
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, algorithms):
+    """
+    Calculate checksums of a file with a list of algorithms, in a single pass.
+    The file is memory-mapped and hashed in chunks.
+
+    Returns:
+        A dict of hex digests keyed by algorithm
+    """
+    hashes = {algorithm: new_hash(algorithm) for algorithm in algorithms}
+    with open(path, "rb") as data_file:
+        # Empty files can't be mapped
+        if os.fstat(data_file.fileno()).st_size:
+            with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for start in range(0, len(view), HASH_CHUNK):
+                    for file_hash in hashes.values():
+                        file_hash.update(view[start:start + HASH_CHUNK])
+    return {algorithm: file_hash.hexdigest() for algorithm, file_hash in hashes.items()}
+
+
+def content_fingerprint(path):
+    """
+    A fingerprint of a file's contents. Unlike its modification time, this survives
+    a fresh clone of the repository. Returns None if the file doesn't exist.
+    """
+    try:
+        return hash_file(path, ["sha256"])["sha256"]
+    except FileNotFoundError:
+        return None
+
+
+def scan_dir(path, recursive=False):
+    """
+    Count the entries in a directory with os.scandir, without listing them.
+    If recursive is True, also count the files in it and its subdirectories,
+    totalling their sizes and counting their extensions.
+    """
+    stats = {"entries": 0, "files": 0, "size": 0, "extensions": Counter()}
+    pending = [str(path)]
+    while pending:
+        current = pending.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if current == str(path):
+                    stats["entries"] += 1
+                if not recursive:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stats["files"] += 1
+                    stats["size"] += entry.stat(follow_symlinks=False).st_size
+                    stats["extensions"][os.path.splitext(entry.name)[1].lower()] += 1
+    stats["extensions"] = dict(stats["extensions"])
+    return stats
+
+
+def get_formats(extensions):
+    """
+    Get the media types of a set of file extensions, most common first.
+
+    Parameters:
+        extensions: a dict of file counts keyed by extension
+    """
+    formats = Counter()
+    for extension, count in extensions.items():
+        if media_type := mimetypes.guess_type(f"file{extension}")[0]:
+            formats[media_type] += count
+    return [media_type for media_type, _ in sorted(formats.items(), key=lambda item: (-item[1], item[0]))]
+
+
+class MetadataCache:
+    """
+    A persistent cache of web page metadata, keyed by url and the kind of request it came
+    from: "title" for the title (or lack of one) from a GET, "head" for the headers from a
+    HEAD request. Each kind has its own validators and freshness.
+    Stale records are kept so they can be revalidated with conditional requests.
+    """
+
+    FIELDS = ["title", "content_length", "last_modified", "etag", "fetched"]
+
+    def __init__(self, path=None, ttl=CACHE_TTL, max_age=CACHE_MAX_AGE):
+        self.path = Path(path) if path else Path(CACHE_DIR, "crate-metadata.sqlite")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_age = max_age
+        # The cache is shared by the threads that resolve urls, so access is serialised with a lock
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS web_metadata "
+            "(url TEXT, kind TEXT, title, content_length, last_modified, etag, fetched REAL, "
+            "PRIMARY KEY (url, kind))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS github_repos "
+            "(full_name TEXT PRIMARY KEY, default_branch TEXT, fetched REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS row_counts "
+            "(path TEXT, csv_records INTEGER, size INTEGER, mtime INTEGER, rows INTEGER, fetched REAL, "
+            "PRIMARY KEY (path, csv_records))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS dir_stats "
+            "(path TEXT, recursive INTEGER, mtime INTEGER, stats TEXT, fetched REAL, "
+            "PRIMARY KEY (path, recursive))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS checksums "
+            "(path TEXT, algorithms TEXT, inode INTEGER, size INTEGER, mtime INTEGER, digests TEXT, "
+            "fetched REAL, PRIMARY KEY (path, algorithms))"
+        )
+        self.purge()
+
+    def purge(self):
+        """
+        Remove records that haven't been refreshed within max_age.
+        """
+        with self.lock, self.db:
+            for table in ["web_metadata", "github_repos", "row_counts", "dir_stats", "checksums"]:
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE fetched < ?", (time.time() - self.max_age,)
+                )
+
+    def get(self, url, kind="title"):
+        with self.lock:
+            return self.read(url, kind)
+
+    def read(self, url, kind):
+        row = self.db.execute(
+            f"SELECT {', '.join(self.FIELDS)} FROM web_metadata WHERE url = ? AND kind = ?",
+            (url, kind),
+        ).fetchone()
+        if row:
+            return dict(zip(self.FIELDS, row))
+
+    def set(self, url, kind="title", **values):
+        """
+        Update the given fields of a record, keeping the others, and mark it as fresh.
+        """
+        values["fetched"] = time.time()
+        columns = ", ".join(values)
+        updates = ", ".join(f"{field} = excluded.{field}" for field in values)
+        with self.lock, self.db:
+            self.db.execute(
+                f"INSERT INTO web_metadata (url, kind, {columns}) VALUES (?, ?{', ?' * len(values)}) "
+                f"ON CONFLICT (url, kind) DO UPDATE SET {updates}",
+                [url, kind] + list(values.values()),
+            )
+            return self.read(url, kind)
+
+    def touch(self, url, kind="title"):
+        """
+        Mark a record as fresh after the server confirms it hasn't changed.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE web_metadata SET fetched = ? WHERE url = ? AND kind = ?",
+                (time.time(), url, kind),
+            )
+
+    def get_default_branch(self, full_name, fresh=True):
+        """
+        Get the cached default branch of a GitHub repository, if it's still fresh
+        (or however old it is if fresh is False).
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT default_branch, fetched FROM github_repos WHERE full_name = ?",
+                (full_name,),
+            ).fetchone()
+        if row and (not fresh or self.is_fresh({"fetched": row[1]})):
+            return row[0]
+
+    def set_default_branch(self, full_name, default_branch):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO github_repos (full_name, default_branch, fetched) VALUES (?, ?, ?)",
+                (full_name, default_branch, time.time()),
+            )
+
+    def get_row_count(self, path, csv_records, size, mtime):
+        """
+        Get the cached row count of a local file, if the file hasn't changed since it was counted.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT rows FROM row_counts WHERE path = ? AND csv_records = ? AND size = ? AND mtime = ?",
+                (path, csv_records, size, mtime),
+            ).fetchone()
+        if row:
+            return row[0]
+
+    def set_row_count(self, path, csv_records, size, mtime, rows):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO row_counts (path, csv_records, size, mtime, rows, fetched) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path, csv_records, size, mtime, rows, time.time()),
+            )
+
+    def get_dir_stats(self, path, recursive, mtime):
+        """
+        Get the cached stats of a local directory, if its modification time hasn't changed.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT stats FROM dir_stats WHERE path = ? AND recursive = ? AND mtime = ?",
+                (path, recursive, mtime),
+            ).fetchone()
+        if row:
+            return json.loads(row[0])
+
+    def set_dir_stats(self, path, recursive, mtime, stats):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO dir_stats (path, recursive, mtime, stats, fetched) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (path, recursive, mtime, json.dumps(stats), time.time()),
+            )
+
+    def get_checksums(self, path, algorithms, inode, size, mtime):
+        """
+        Get the cached checksums of a local file, if the file hasn't changed since it was hashed.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT digests FROM checksums "
+                "WHERE path = ? AND algorithms = ? AND inode = ? AND size = ? AND mtime = ?",
+                (path, algorithms, inode, size, mtime),
+            ).fetchone()
+        if row:
+            return json.loads(row[0])
+
+    def set_checksums(self, path, algorithms, inode, size, mtime, digests):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO checksums (path, algorithms, inode, size, mtime, digests, fetched) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, algorithms, inode, size, mtime, json.dumps(digests), time.time()),
+            )
+
+    def is_fresh(self, record):
+        return time.time() - record["fetched"] < self.ttl
+
+    def validators(self, record):
+        """
+        Headers for a conditional request based on a cached record.
+        """
+        headers = {}
+        if record.get("etag"):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            headers["If-Modified-Since"] = record["last_modified"]
+        return headers
+
+
+class TokenBucket:
+    """
+    Limits the rate of requests to a host. Tokens are added at a steady rate, up to
+    a maximum, and each request takes one, waiting for it if there are none left.
+    """
+
+    def __init__(self, rate=HOST_RATE, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate * 2
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Take a token, sleeping until one is available.
+
+        Returns:
+            The number of seconds waited
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens can go negative, reserving the next ones for requests that are waiting
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Profiler:
+    """
+    Records the time spent in each phase of a run, HTTP requests by host,
+    and cache hits and misses. Phases can also be saved as trace spans.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.requests = Counter()
+        self.cache_hits = Counter()
+        self.cache_misses = Counter()
+        self.spans = []
+        self.lock = threading.Lock()
+        # Each thread keeps its own stack of open spans, so nested phases have parents
+        self.local = threading.local()
+        self.trace_id = os.urandom(16).hex()
+
+    @contextlib.contextmanager
+    def phase(self, name, **attributes):
+        stack = self.local.__dict__.setdefault("stack", [])
+        span = {
+            "name": name,
+            "trace_id": self.trace_id,
+            "span_id": os.urandom(8).hex(),
+            "parent_span_id": stack[-1]["span_id"] if stack else None,
+            "start_time_unix_nano": time.time_ns(),
+            "attributes": attributes,
+        }
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            span["end_time_unix_nano"] = time.time_ns()
+            with self.lock:
+                phase = self.phases.setdefault(name, {"calls": 0, "seconds": 0})
+                phase["calls"] += 1
+                phase["seconds"] += seconds
+                self.spans.append(span)
+
+    def count_request(self, url):
+        with self.lock:
+            self.requests[urlparse(url).netloc] += 1
+
+    def count_cache(self, name, hit):
+        with self.lock:
+            if hit:
+                self.cache_hits[name] += 1
+            else:
+                self.cache_misses[name] += 1
+
+    def report(self):
+        return {
+            "phases": {
+                name: {"calls": phase["calls"], "seconds": round(phase["seconds"], 4)}
+                for name, phase in self.phases.items()
+            },
+            "requests": dict(self.requests),
+            "cache": {
+                name: {"hits": self.cache_hits[name], "misses": self.cache_misses[name]}
+                for name in sorted(set(self.cache_hits) | set(self.cache_misses))
+            },
+        }
+
+    def summary(self):
+        """
+        Format the report as plain text tables.
+        """
+        report = self.report()
+        width = max([len(name) for name in report["phases"]] + [24])
+        lines = [f"{'Phase':<{width}}{'Calls':>8}{'Seconds':>10}"]
+        for name, phase in sorted(report["phases"].items(), key=lambda p: -p[1]["seconds"]):
+            lines.append(f"{name:<{width}}{phase['calls']:>8}{phase['seconds']:>10.3f}")
+        width = max([len(host) for host in self.requests] + [24])
+        lines += ["", f"{'Host':<{width}}{'Requests':>10}"]
+        for host, count in self.requests.most_common():
+            lines.append(f"{host:<{width}}{count:>10}")
+        width = max([len(name) for name in report["cache"]] + [24])
+        lines += ["", f"{'Cache':<{width}}{'Hits':>8}{'Misses':>8}{'Hit rate':>10}"]
+        for name, counts in report["cache"].items():
+            rate = counts["hits"] / (counts["hits"] + counts["misses"])
+            lines.append(f"{name:<{width}}{counts['hits']:>8}{counts['misses']:>8}{rate:>10.0%}")
+        return "\n".join(lines)
+
+    def write(self, path):
+        Path(path).write_text(json.dumps(self.report(), indent=4))
+
+    def write_spans(self, path):
+        """
+        Save the phases as OpenTelemetry-style spans, one JSON object per line.
+        """
+        with Path(path).open("w") as trace_file:
+            for span in self.spans:
+                trace_file.write(json.dumps(span) + "\n")
+
+
+class EntityIndex:
+    """
+    Indexes the entities of a crate by @id, by @type, and by the entities that refer to them.
+    Ids are resolved as the crate resolves them, so lookups match crate.get. References are
+    recorded when an entity is added, so an entity should be added again when they change.
+    """
+
+    def __init__(self, entities=(), resolve_id=None):
+        self.resolve_id = resolve_id or (lambda entity_id: entity_id)
+        self.by_id = {}
+        self.by_type = {}
+        self.types = {}
+        self.references = {}
+        self.referrers = {}
+        for entity in entities:
+            self.add(entity)
+
+    def add(self, entity):
+        """
+        Add an entity to the index, replacing any entity with the same id.
+        """
+        key = self.resolve_id(entity.id)
+        self.remove(key)
+        self.by_id[key] = entity
+        self.types[key] = set(listify(entity.type))
+        for entity_type in self.types[key]:
+            self.by_type.setdefault(entity_type, {})[key] = entity
+        self.references[key] = set()
+        for value in entity.properties().values():
+            for item in listify(value):
+                if isinstance(item, dict) and "@id" in item:
+                    target = self.resolve_id(item["@id"])
+                    self.references[key].add(target)
+                    self.referrers.setdefault(target, set()).add(key)
+        return entity
+
+    def remove(self, entity_id):
+        key = self.resolve_id(entity_id)
+        if self.by_id.pop(key, None) is None:
+            return
+        for entity_type in self.types.pop(key):
+            del self.by_type[entity_type][key]
+        for target in self.references.pop(key):
+            self.referrers[target].discard(key)
+
+    def get(self, entity_id, default=None):
+        return self.by_id.get(self.resolve_id(entity_id), default)
+
+    def get_by_type(self, type_):
+        """
+        Get the entities that have all of the given types.
+        """
+        types = set(listify(type_))
+        candidates = self.by_type.get(next(iter(types)), {}) if types else {}
+        return [entity for key, entity in candidates.items() if types <= self.types[key]]
+
+    def get_referrers(self, entity_id, type_=None):
+        """
+        Get the entities that refer to an entity, optionally only those of the given types.
+        """
+        types = set(listify(type_ or []))
+        return [
+            self.by_id[key]
+            for key in self.referrers.get(self.resolve_id(entity_id), [])
+            if types <= self.types[key]
+        ]
+
+
+class LiveResolver:
+    """
+    Looks up page titles, web file stats and GitHub metadata on the web,
+    using the CrateMaker's metadata cache and GitHub client.
+
+    A resolver's lookups return None for anything it can't find. Offline
+    resolvers never touch the network.
+    """
+
+    offline = False
+
+    def __init__(self, crate_maker):
+        self.crate_maker = crate_maker
+
+    def get_page_title(self, url):
+        return self.crate_maker.read_page_title(url)
+
+    def get_web_file_stats(self, url):
+        return self.crate_maker.read_web_file_stats(url)
+
+    def get_default_gh_branch(self, full_name):
+        return self.crate_maker.read_default_gh_branch(f"https://github.com/{full_name}")
+
+    def index_gh_files(self, urls):
+        self.crate_maker.index_gh_files(urls)
+
+
+class CacheResolver:
+    """
+    Looks up page titles, web file stats and GitHub default branches in the
+    metadata cache, however old they are, without touching the network.
+    """
+
+    offline = True
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_page_title(self, url):
+        if cached := self.cache.get(url):
+            return cached["title"]
+
+    def get_web_file_stats(self, url):
+        import arrow
+
+        cached = self.cache.get(url, "head")
+        if cached and cached["last_modified"]:
+            return {
+                "sdDatePublished": arrow.get(cached["fetched"]).isoformat(),
+                "contentSize": cached["content_length"],
+                "dateModified": http_date_to_iso(cached["last_modified"]),
+            }
+
+    def get_default_gh_branch(self, full_name):
+        return self.cache.get_default_branch(full_name, fresh=False)
+
+    def index_gh_files(self, urls):
+        pass
+
+
+class FixtureResolver:
+    """
+    Looks up page titles, web file stats and GitHub default branches in a JSON file, eg:
+
+        {
+            "titles": {"https://glam-workbench.net/": "GLAM Workbench"},
+            "file_stats": {"https://example.com/data.csv": {"contentSize": 23000, "dateModified": "2024-09-13T07:01:28+00:00"}},
+            "default_branches": {"GLAM-Workbench/recordsearch": "master"}
+        }
+    """
+
+    offline = True
+
+    def __init__(self, path):
+        self.fixtures = json.loads(Path(path).read_text())
+
+    def get_page_title(self, url):
+        return self.fixtures.get("titles", {}).get(url)
+
+    def get_web_file_stats(self, url):
+        return self.fixtures.get("file_stats", {}).get(url)
+
+    def get_default_gh_branch(self, full_name):
+        return self.fixtures.get("default_branches", {}).get(full_name)
+
+    def index_gh_files(self, urls):
+        pass
+
+
 class CrateMaker:
 
-    def __init__(self, crate_path="./", defaults=None, version=None, data_repo=None):
-        # Make working directory the parent of the scripts directory
-        os.chdir(Path(__file__).resolve().parent.parent)
+    def __init__(
+        self,
+        crate_path="./",
+        defaults=None,
+        version=None,
+        data_repo=None,
+        cache=None,
+        csv_records=False,
+        incremental=False,
+        recursive_dir_stats=False,
+        checksums=None,
+        reproducible=False,
+        timeout=HTTP_TIMEOUT,
+        host_rate=HOST_RATE,
+        working_dir=None,
+        profiler=None,
+        resolver=None,
+    ):
+        # Make working directory the repository the crate describes,
+        # by default the parent of the scripts directory
+        os.chdir(working_dir or Path(__file__).resolve().parent.parent)
         self.defaults = defaults
         self.crate_path = crate_path
         self.version = version
         self.data_repo = data_repo
+        self.cache = cache
+        # Count CSV records (allowing for newlines in quoted fields) rather than lines
+        self.csv_records = csv_records
+        # Row counts of local data files keyed by (path, csv_records, size, mtime)
+        self.row_counts = {}
+        # Describe directories by the files in them and their subdirectories
+        self.recursive_dir_stats = recursive_dir_stats
+        # Stats of local directories keyed by (path, recursive, mtime)
+        self.dir_stats = {}
+        # Checksum algorithms for local files, eg ["sha256", "xxh3_64"]
+        self.checksums = checksums or []
+        for algorithm in self.checksums:
+            new_hash(algorithm)
+        # Checksums of local files keyed by (path, algorithms, inode, size, mtime)
+        self.file_checksums = {}
+        # Sort entities and keep old timestamps, so unchanged inputs give an unchanged crate
+        self.reproducible = reproducible
+        # Only regenerate notebooks whose inputs have changed since the last run
+        self.incremental = incremental
+        # Timings, request and cache counts
+        self.profiler = profiler or Profiler()
+        # Local git repository details, set by get_repo_context
+        self.repo_context = None
+        # Where page titles, web file stats and GitHub metadata are looked up
+        self.resolver = resolver or LiveResolver(self)
+        # Urls an offline resolver couldn't resolve, and what was missing
+        self.unresolved = {}
+        # HTTP session shared by all web requests, and the rate limits of each host
+        # (requests per second, or None for no limit)
+        self.timeout = timeout
+        self.host_rate = host_rate
+        self.http_session = None
+        self.http_lock = threading.Lock()
+        self.host_limits = {}
+        # GitHub client and the repositories and default branches it's looked up.
+        # Urls are resolved in threads, so each repository is only looked up by one at a time
+        self.gh_client = None
+        self.gh_authenticated = False
+        self.gh_repos = {}
+        self.gh_branches = {}
+        self.gh_lock = threading.Lock()
+        self.gh_repo_locks = {}
+        # Stats of GitHub files keyed by (owner/repo, path), filled by index_gh_files
+        self.gh_file_stats = {}
+        # Notebook metadata, read once per notebook
+        self.nb_metadata = {}
+        # Page titles, web file stats and local file stats fetched by resolve_urls
+        # (or, for page titles, by get_page_title)
+        self.page_titles = {}
+        self.web_file_stats = {}
+        self.local_file_stats = {}
+        # Errors raised fetching page titles and web file stats in resolve_urls, keyed by url,
+        # to be raised again when the crate is built rather than fetching them again
+        self.page_title_errors = {}
+        self.web_file_stats_errors = {}
+        # Entities of existing crates keyed by metadata path, filled by load_crate_graph
+        self.crate_graphs = {}
+        # Entities of the crate being updated, and urls of pages named without fetching their titles
+        self.old_graph = {}
+        self.named_pages = set()
+        # Index of the entities in self.crate, rebuilt by get_entity_index if the crate is replaced
+        self.entity_index = None
+        self.indexed_crate = None
+
+    @property
+    def data_repo(self):
+        return self._data_repo
+
+    @data_repo.setter
+    def data_repo(self, url):
+        # The data repo's owner/name is parsed once, as it's checked against every data file
+        self._data_repo = url
+        gh_url = parse_gh_url(url) if url else None
+        self.data_repo_name = gh_url.full_name if gh_url else None
+
+    def get_entity_index(self):
+        if self.indexed_crate is not self.crate:
+            self.entity_index = EntityIndex(self.crate.get_entities(), self.crate.resolve_id)
+            self.indexed_crate = self.crate
+        return self.entity_index
+
+    def get_entity(self, entity_id):
+        """
+        Get an entity from the crate by its id, using the entity index.
+        """
+        return self.get_entity_index().get(entity_id)
+
+    def index_entity(self, entity):
+        """
+        Add a new entity, or an entity whose types or references have changed, to the index.
+        """
+        return self.get_entity_index().add(entity)
+
+    def add_entity(self, entity):
+        """
+        Add an entity to the crate and the entity index.
+        """
+        return self.index_entity(self.crate.add(entity))
 
     def id_ify(self, elements):
         """Wraps elements in a list with @id keys
@@ -86,10 +1124,9 @@ class CrateMaker:
             return True
         else:
             metadata = self.get_nb_metadata(notebook)
-            owner, repo = self.get_gh_parts(self.data_repo)
             for action in metadata.get("action", []):
                 for result in action.get("result", []):
-                    if f"{owner}/{repo}" in result.get("url", ""):
+                    if self.file_in_repo(result):
                         return True
         return False
 
@@ -102,7 +1139,7 @@ class CrateMaker:
         Returns:
             Paths of the notebooks found in the directory
         """
-        files = Path(path).glob("*.ipynb")
+        files = sorted(Path(path).glob("*.ipynb"))
         is_notebook = lambda file: not file.name.lower().startswith(
             ("draft", "untitled", "index")
         ) and self.creates_data(file)
@@ -128,6 +1165,8 @@ class CrateMaker:
         Returns:
             A list of Persons.
         """
+        from rocrate.model.person import Person
+
         added = []
         # Loop through list of authors
         for author_data in authors:
@@ -143,19 +1182,32 @@ class CrateMaker:
             else:
                 author_id = author_data["orcid"]
             # Check to see if there's already an entry for this person in the crate
-            author = self.crate.get(author_id)
+            author = self.get_entity(author_id)
 
             # If there's already an entry we'll update the existing properties
             if not author:
                 props = {"name": author_data["name"]}
-                author = self.crate.add(Person(self.crate, author_id, properties=props))
+                author = self.add_entity(Person(self.crate, author_id, properties=props))
             added.append(self.update_properties(author, author_data, exclude=["orcid"]))
         return added
 
+    def merge_authors(self, *author_lists):
+        """
+        Merge lists of authors, dropping duplicates by @id.
+        Authors are kept in the order they're first seen.
+        """
+        merged = {}
+        for authors in author_lists:
+            for author in listify(authors or []):
+                merged.setdefault(author["@id"], author)
+        return list(merged.values())
+
     def add_update_action(self, version):
         """
         Adds an UpdateAction to the crate when the repo version is updated.
         """
+        from rocrate.model.contextentity import ContextEntity
+
         # Create an id for the action using the version number
         action_id = f"create_version_{version.replace('.', '_')}"
 
@@ -168,7 +1220,7 @@ class CrateMaker:
         }
 
         # Create entity
-        self.crate.add(ContextEntity(self.crate, action_id, properties=properties))
+        self.add_entity(ContextEntity(self.crate, action_id, properties=properties))
 
     def add_context_entity(self, entity):
         """
@@ -178,7 +1230,9 @@ class CrateMaker:
             crate: the current ROCrate
             entity: A JSONLD ready dict containing "@id" and "@type" values
         """
-        return self.crate.add(
+        from rocrate.model.contextentity import ContextEntity
+
+        return self.add_entity(
             ContextEntity(self.crate, entity["@id"], properties=entity)
         )
 
@@ -191,7 +1245,7 @@ class CrateMaker:
             page_data = {"url": page_data}
         page_id = page_data["url"]
         # Check if there's already an entity for this page
-        page = self.crate.get(page_id)
+        page = self.get_entity(page_id)
         # If there's not an existing page entity, create one
         if not page:
             # Default properties, might be overwritten by values from page_data
@@ -204,15 +1258,26 @@ class CrateMaker:
             page = self.add_context_entity(props)
         # Update the context entity with additional properties from page data
         page = self.update_properties(page, page_data)
-        # If there's a specific name in an existing record we want to keep it.
-        # Otherwise add a default name from the page title
-        default_name = self.get_page_title(page_data["url"])
-        if "name" in page_data and page.get("name") == default_name:
-            page["name"] = page_data["name"]
-        elif not page.get("name"):
-            page["name"] = default_name
+        # If there's a specific name in the page data or an existing record we want to keep it.
+        # Otherwise add a default name from the old crate or the page title
+        if page.get("name"):
+            self.named_pages.add(page_id)
+        else:
+            page["name"] = self.get_page_name(page_id)
         return page
 
+    def get_page_name(self, url):
+        """
+        Get a name for a page, using the name in the old crate before looking up its title.
+        """
+        if name := self.get_old_name(url):
+            self.named_pages.add(url)
+            return name
+        return self.get_page_title(url)
+
+    def get_old_name(self, url):
+        return self.old_graph.get(url, {}).get("name")
+
     def add_pages(self, pages, type="CreativeWork"):
         """
         Add related pages
@@ -226,7 +1291,7 @@ class CrateMaker:
     def add_licence(self, licences):
         added = []
         for licence in licences:
-            added.append(self.add_context_entity(LICENCES[licence]))
+            added.append(self.add_context_entity(load_licences()[licence]))
         return added
 
     def add_download(self, downloads):
@@ -256,13 +1321,33 @@ class CrateMaker:
             added = self.add_pages(entities)
         if added and entity_type != "action":
             record[entity_type] = delistify(added)
+            self.index_entity(record)
 
     def get_local_file_stats(self, local_path):
+        self.profiler.count_cache("resolved local file stats", str(local_path) in self.local_file_stats)
+        if str(local_path) in self.local_file_stats:
+            return self.local_file_stats[str(local_path)]
+        return self.fetch_local_file_stats(local_path)
+
+    def fetch_local_file_stats(self, local_path):
+        with self.profiler.phase("local file stats"):
+            return self.read_local_file_stats(local_path)
+
+    def read_local_file_stats(self, local_path):
+        import arrow
+
         stats = {}
         local_file = Path(local_path)
         if local_file.is_dir():
-            stats["size"] = len(list(local_file.glob("*")))
             file_stats = local_file.stat()
+            dir_stats = self.scan_dir(local_file, file_stats)
+            if self.recursive_dir_stats:
+                stats["size"] = dir_stats["files"]
+                stats["contentSize"] = dir_stats["size"]
+                if formats := get_formats(dir_stats["extensions"]):
+                    stats["encodingFormat"] = delistify(formats)
+            else:
+                stats["size"] = dir_stats["entries"]
             stats["dateModified"] = arrow.get(file_stats.st_mtime).isoformat()
         else:
             stats["sdDatePublished"] = arrow.utcnow().isoformat()
@@ -271,49 +1356,383 @@ class CrateMaker:
             stats["contentSize"] = file_stats.st_size
             stats["dateModified"] = arrow.get(file_stats.st_mtime).isoformat()
             if local_file.name.endswith((".csv", ".ndjson")):
-                stats["size"] = 0
-                with local_file.open("r") as df:
-                    for line in df:
-                        stats["size"] += 1
+                stats["size"] = self.count_rows(local_file, file_stats)
+            if self.checksums:
+                stats.update(self.get_checksums(local_file, file_stats))
         return stats
 
+    def scan_dir(self, local_dir, file_stats):
+        """
+        Get the stats of a local directory. Stats are remembered for the run, and entry
+        counts are cached by path and modification time, so unchanged directories are
+        only scanned once. A directory's modification time only changes when its own
+        entries are added, removed or renamed, not when anything in its subdirectories
+        changes, so recursive stats aren't cached between runs.
+        """
+        key = (str(local_dir.resolve()), self.recursive_dir_stats, file_stats.st_mtime_ns)
+        if key not in self.dir_stats:
+            use_cache = self.cache and not self.recursive_dir_stats
+            stats = self.cache.get_dir_stats(*key) if use_cache else None
+            self.profiler.count_cache("directory stats", stats is not None)
+            if stats is None:
+                with self.profiler.phase("directory scanning"):
+                    stats = scan_dir(local_dir, self.recursive_dir_stats)
+                if use_cache:
+                    self.cache.set_dir_stats(*key, stats)
+            self.dir_stats[key] = stats
+        return self.dir_stats[key]
+
+    def row_count_key(self, local_file, file_stats):
+        csv_records = self.csv_records and local_file.name.endswith(".csv")
+        return (str(local_file.resolve()), csv_records, file_stats.st_size, file_stats.st_mtime_ns)
+
+    def count_rows(self, local_file, file_stats):
+        """
+        Count the rows in a CSV or NDJSON file. Counts are cached by path, size and
+        modification time, so unchanged files are only scanned once.
+        """
+        key = self.row_count_key(local_file, file_stats)
+        if key not in self.row_counts:
+            rows = self.cache.get_row_count(*key) if self.cache else None
+            self.profiler.count_cache("row counts", rows is not None)
+            if rows is None:
+                with self.profiler.phase("row counting"):
+                    rows = count_file_rows(local_file, key[1])
+                if self.cache:
+                    self.cache.set_row_count(*key, rows)
+            self.row_counts[key] = rows
+        return self.row_counts[key]
+
+    def checksum_key(self, local_file, file_stats):
+        return (
+            str(local_file.resolve()),
+            ",".join(self.checksums),
+            file_stats.st_ino,
+            file_stats.st_size,
+            file_stats.st_mtime_ns,
+        )
+
+    def get_checksums(self, local_file, file_stats):
+        """
+        Get the checksums of a local file. Checksums are cached by path, inode, size
+        and modification time, so unchanged files are only hashed once.
+        """
+        key = self.checksum_key(local_file, file_stats)
+        if key not in self.file_checksums:
+            digests = self.cache.get_checksums(*key) if self.cache else None
+            self.profiler.count_cache("checksums", digests is not None)
+            if digests is None:
+                with self.profiler.phase("hashing"):
+                    digests = hash_file(local_file, self.checksums)
+                if self.cache:
+                    self.cache.set_checksums(*key, digests)
+            self.file_checksums[key] = digests
+        return self.file_checksums[key]
+
+    def resolve_local_files(self, local_paths):
+        """
+        Gather the stats of local files before the crate is built. Rows are counted
+        and checksums calculated in a pool of processes, as they're CPU bound, and
+        the rest of the stats are read in threads.
+
+        Parameters:
+            local_paths: paths of local files and directories
+        """
+        jobs = {}
+        for local_path in local_paths:
+            local_file = Path(local_path)
+            if not local_file.is_file():
+                continue
+            file_stats = local_file.stat()
+            if local_file.name.endswith((".csv", ".ndjson")):
+                key = self.row_count_key(local_file, file_stats)
+                cached = self.cache.get_row_count(*key) if self.cache else None
+                if key not in self.row_counts and cached is None:
+                    jobs[("rows", key)] = (count_file_rows, Path(key[0]), key[1])
+            if self.checksums:
+                key = self.checksum_key(local_file, file_stats)
+                cached = self.cache.get_checksums(*key) if self.cache else None
+                if key not in self.file_checksums and cached is None:
+                    jobs[("checksums", key)] = (hash_file, Path(key[0]), self.checksums)
+        # A single job isn't worth starting processes for, it's done with the other stats
+        if len(jobs) > 1:
+            with self.profiler.phase("row counting and hashing"), ProcessPoolExecutor() as executor:
+                futures = {job: executor.submit(*args) for job, args in jobs.items()}
+            for (job_type, key), future in futures.items():
+                try:
+                    result = future.result()
+                # Missing files are left unresolved, so the error is raised when the crate is built
+                except OSError:
+                    continue
+                if job_type == "rows":
+                    self.profiler.count_cache("row counts", False)
+                    self.row_counts[key] = result
+                    if self.cache:
+                        self.cache.set_row_count(*key, result)
+                else:
+                    self.profiler.count_cache("checksums", False)
+                    self.file_checksums[key] = result
+                    if self.cache:
+                        self.cache.set_checksums(*key, result)
+
+        def resolve(local_path):
+            try:
+                self.local_file_stats[str(local_path)] = self.fetch_local_file_stats(local_path)
+            # Missing files are left unresolved, so the error is raised when the crate is built
+            except OSError:
+                pass
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(resolve, local_paths))
+
     def get_web_file_stats(self, url):
+        self.profiler.count_cache("resolved file stats", url in self.web_file_stats)
+        if url in self.web_file_stats:
+            return self.web_file_stats[url]
+        if url in self.web_file_stats_errors:
+            raise self.web_file_stats_errors[url]
+        return self.fetch_web_file_stats(url)
+
+    def fetch_web_file_stats(self, url):
+        with self.profiler.phase("web file stats"):
+            stats = self.resolver.get_web_file_stats(url)
+        if stats is None:
+            self.mark_unresolved(url, "file stats")
+        return stats or {}
+
+    def read_web_file_stats(self, url):
+        import arrow
+
         stats = {"sdDatePublished": arrow.utcnow().isoformat()}
-        if "github" in url:
-            repo = self.get_gh_repo(url)
-            file_path = url.split(f"/{repo.default_branch}/")[-1]
-            contents = repo.get_contents(file_path)
-            stats["contentSize"] = contents.size
-            stats["dateModified"] = contents.last_modified_datetime.isoformat()
+        gh_url = parse_gh_url(url)
+        if gh_url and gh_url.kind in ["blob", "raw"] and gh_url.path:
+            if indexed := self.gh_file_stats.get((gh_url.full_name, gh_url.path)):
+                stats.update(indexed)
+            else:
+                repo = self.get_gh_repo(url)
+                self.profiler.count_request(GH_API_URL)
+                contents = repo.get_contents(gh_url.path)
+                stats["contentSize"] = contents.size
+                stats["dateModified"] = contents.last_modified_datetime.isoformat()
         else:
-            response = requests.head(url)
-            stats["contentSize"] = response.headers.get("Content-length")
-            stats["dateModified"] = arrow.get(
-                response.headers.get("Last-Modified"), "ddd, D MMM YYYY HH:mm:ss ZZZ"
-            ).isoformat()
+            headers = self.get_head_metadata(url)
+            stats["contentSize"] = headers["content_length"]
+            stats["dateModified"] = http_date_to_iso(headers["last_modified"])
         return stats
 
+    def get_head_metadata(self, url):
+        """
+        Get the size and modification date of a web resource from a HEAD request,
+        using the metadata cache where possible.
+        """
+        cached = self.cache.get(url, "head") if self.cache else None
+        if cached:
+            if self.cache.is_fresh(cached):
+                self.profiler.count_cache("http headers", True)
+                return cached
+            self.profiler.count_request(url)
+            response = self.http_request("head", url, headers=self.cache.validators(cached))
+            if response.status_code == 304:
+                self.profiler.count_cache("http headers", True)
+                self.cache.touch(url, "head")
+                return cached
+        else:
+            self.profiler.count_request(url)
+            response = self.http_request("head", url)
+        self.profiler.count_cache("http headers", False)
+        metadata = {
+            "content_length": response.headers.get("Content-length"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "etag": response.headers.get("ETag"),
+        }
+        if self.cache:
+            metadata = self.cache.set(url, "head", **metadata)
+        return metadata
+
+    def get_http_session(self):
+        """
+        Get an HTTP session shared by all web requests in this run, so connections
+        are kept alive and reused. Failed connections and 429/5xx responses are
+        retried with exponential backoff.
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        with self.http_lock:
+            if not self.http_session:
+                retry = Retry(
+                    total=HTTP_RETRIES,
+                    backoff_factor=HTTP_BACKOFF,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=["GET", "HEAD"],
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(max_retries=retry, pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+                self.http_session = requests.Session()
+                self.http_session.mount("http://", adapter)
+                self.http_session.mount("https://", adapter)
+        return self.http_session
+
+    def http_request(self, method, url, **kwargs):
+        """
+        Make a GET or HEAD request with the shared session, limiting the rate of
+        requests to each host.
+        """
+        if self.host_rate:
+            self.get_host_limit(urlparse(url).netloc).take()
+        request = getattr(self.get_http_session(), method)
+        return request(url, timeout=self.timeout, **kwargs)
+
+    def get_host_limit(self, host):
+        """
+        Get the rate limit of a host, creating it the first time the host is requested.
+        """
+        with self.http_lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = TokenBucket(self.host_rate)
+            return self.host_limits[host]
+
     def get_gh_parts(self, url):
-        try:
-            owner, repo = re.search(
-                r"https*://.*(?:github|githubusercontent).com/(.+?)/([a-zA-Z0-9\-_]+)", url
-            ).groups()
-        except AttributeError:
-            owner = None
-            repo = None
-        return owner, repo
+        if gh_url := parse_gh_url(url):
+            return gh_url.owner, gh_url.repo
+        return None, None
+
+    def get_gh_client(self):
+        """
+        Get a GitHub client shared by all requests in this run.
+        If there's a token in the GITHUB_TOKEN environment variable the client will be
+        authenticated, raising the API rate limit.
+        """
+        from github import Github, Auth
+
+        with self.gh_lock:
+            if not self.gh_client:
+                if token := os.environ.get("GITHUB_TOKEN"):
+                    self.gh_client = Github(auth=Auth.Token(token), timeout=self.timeout)
+                    self.gh_authenticated = True
+                else:
+                    self.gh_client = Github(timeout=self.timeout)
+        return self.gh_client
+
+    def get_gh_repo_lock(self, full_name):
+        """
+        Get the lock held while a GitHub repository's details are looked up.
+        It's reentrant, as looking up a default branch can look up the repository.
+        """
+        with self.gh_lock:
+            return self.gh_repo_locks.setdefault(full_name, threading.RLock())
 
     def get_gh_repo(self, url):
         owner, repo = self.get_gh_parts(url)
         if owner and repo:
-            g = Github()
-            return g.get_repo(full_name_or_id=f"{owner}/{repo}")
+            full_name = f"{owner}/{repo}"
+            with self.get_gh_repo_lock(full_name):
+                if full_name not in self.gh_repos:
+                    self.profiler.count_request(GH_API_URL)
+                    with self.profiler.phase("github"):
+                        self.gh_repos[full_name] = self.get_gh_client().get_repo(
+                            full_name_or_id=full_name
+                        )
+            return self.gh_repos[full_name]
+
+    def index_gh_files(self, urls):
+        """
+        Look up the stats of GitHub files in bulk. Sizes come from a single request for each
+        repository's git tree, and last commit dates from batched GraphQL queries. GraphQL
+        needs an authenticated client, so without a token nothing is indexed. Files that
+        can't be indexed are looked up one at a time by get_web_file_stats.
+
+        Parameters:
+            urls: urls of files in GitHub repositories
+        """
+        from github import GithubException
+
+        self.get_gh_client()
+        if not self.gh_authenticated:
+            return
+        repo_paths = {}
+        for url in urls:
+            gh_url = parse_gh_url(url)
+            if gh_url and gh_url.kind in ["blob", "raw"] and gh_url.path:
+                repo_paths.setdefault(gh_url.full_name, set()).add(gh_url.path)
+        for full_name, paths in repo_paths.items():
+            repo_url = f"https://github.com/{full_name}"
+            try:
+                default_branch = self.get_default_gh_branch(repo_url)
+                repo = self.get_gh_repo(repo_url)
+                self.profiler.count_request(GH_API_URL)
+                with self.profiler.phase("github"):
+                    tree = repo.get_git_tree(default_branch, recursive=True)
+                sizes = {
+                    element.path: element.size
+                    for element in tree.tree
+                    if element.type == "blob" and element.path in paths
+                }
+                dates = self.get_gh_commit_dates(full_name, default_branch, list(sizes))
+            except GithubException:
+                continue
+            for path, size in sizes.items():
+                if path in dates:
+                    self.gh_file_stats[(full_name, path)] = {
+                        "contentSize": size,
+                        "dateModified": dates[path],
+                    }
+
+    def get_gh_commit_dates(self, full_name, branch, paths):
+        """
+        Get the dates of the last commits to a list of paths in a GitHub repository,
+        using one GraphQL query for each batch of paths.
+        """
+        import arrow
+
+        dates = {}
+        if not self.gh_authenticated:
+            return dates
+        owner, repo_name = full_name.split("/")
+        for start in range(0, len(paths), GH_GRAPHQL_BATCH):
+            batch = paths[start:start + GH_GRAPHQL_BATCH]
+            histories = " ".join(
+                f"f{index}: history(first: 1, path: {json.dumps(path)}) {{ nodes {{ committedDate }} }}"
+                for index, path in enumerate(batch)
+            )
+            query = (
+                "query($owner: String!, $name: String!, $branch: String!) { "
+                "repository(owner: $owner, name: $name) { object(expression: $branch) { "
+                f"... on Commit {{ {histories} }} }} }} }}"
+            )
+            self.profiler.count_request(GH_API_URL)
+            with self.profiler.phase("github"):
+                _, data = self.get_gh_client().requester.graphql_query(
+                    query, {"owner": owner, "name": repo_name, "branch": branch}
+                )
+            commit = data["data"]["repository"]["object"]
+            for index, path in enumerate(batch):
+                if nodes := commit[f"f{index}"]["nodes"]:
+                    dates[path] = arrow.get(nodes[0]["committedDate"]).isoformat()
+        return dates
 
     def get_gh_path(self, url):
-        default_branch = self.get_default_gh_branch(url)
-        return url.split(f"/{default_branch}/")[-1]
+        gh_url = parse_gh_url(url)
+        return gh_url.path if gh_url else None
 
     def get_repo_info(self):
+        context = self.get_repo_context()
+        return context.name, context.url
+
+    def get_repo_context(self):
+        """
+        Get details of the local git repository. The repository is only read
+        once per run, as every read spawns git subprocesses.
+        """
+        if self.repo_context is None:
+            self.repo_context = self.read_repo_context()
+        return self.repo_context
+
+    def read_repo_context(self):
+        import git
+        from git.exc import InvalidGitRepositoryError, GitCommandError
+
         # Try to get some info from the local git repo
         try:
             repo = git.Repo(".")
@@ -322,10 +1741,20 @@ class CrateMaker:
             )
             repo_name = repo_url.strip("/").split("/")[-1]
         # There is no git repo or no remote set
-        except (InvalidGitRepositoryError, GitCommandError):
-            repo_url = ""
-            repo_name = "example-repo"
-        return repo_name, repo_url
+        except (InvalidGitRepositoryError, GitCommandError, AttributeError):
+            return RepoContext("example-repo", "", None, None)
+        # The remote's default branch is only known locally if origin/HEAD has been set
+        # (eg by cloning), otherwise it's looked up on GitHub when it's needed
+        try:
+            default_branch = repo.remotes.origin.refs.HEAD.reference.remote_head
+        except (AttributeError, IndexError, TypeError, GitCommandError):
+            default_branch = None
+        # A new repository has no commits
+        try:
+            head_commit = repo.head.commit.hexsha
+        except (AttributeError, ValueError, GitCommandError):
+            head_commit = None
+        return RepoContext(repo_name, repo_url, default_branch, head_commit)
 
     def get_repo_link(self, entry):
         """
@@ -353,9 +1782,41 @@ class CrateMaker:
     def get_default_gh_branch(self, url):
         """
         Get the default branch of a GH repository from a url that points to it.
+        Branches are remembered for the run.
         """
-        repo = self.get_gh_repo(url)
-        return repo.default_branch
+        owner, repo_name = self.get_gh_parts(url)
+        full_name = f"{owner}/{repo_name}"
+        with self.get_gh_repo_lock(full_name):
+            if full_name not in self.gh_branches:
+                default_branch = self.resolver.get_default_gh_branch(full_name)
+                # GitHub resolves HEAD to the default branch in file urls
+                if default_branch is None:
+                    self.mark_unresolved(url, "default branch")
+                    default_branch = "HEAD"
+                self.gh_branches[full_name] = default_branch
+        return self.gh_branches[full_name]
+
+    def read_default_gh_branch(self, url):
+        """
+        Get the default branch of a GH repository from the cache, or from GitHub.
+        """
+        owner, repo_name = self.get_gh_parts(url)
+        full_name = f"{owner}/{repo_name}"
+        default_branch = self.cache.get_default_branch(full_name) if self.cache else None
+        self.profiler.count_cache("github branches", default_branch is not None)
+        if not default_branch:
+            default_branch = self.get_gh_repo(url).default_branch
+            if self.cache:
+                self.cache.set_default_branch(full_name, default_branch)
+        return default_branch
+
+    def mark_unresolved(self, url, missing):
+        """
+        Record a url that an offline resolver couldn't resolve.
+        Anything missing from the crate is listed when it's written.
+        """
+        if self.resolver.offline:
+            self.unresolved.setdefault(url, set()).add(missing)
 
     def get_gh_file_url(self, file_path):
         """
@@ -363,9 +1824,9 @@ class CrateMaker:
         Note that you could get the url from the GH repo, but there's a possibility
         that this script will be run before every notebook has been committed and pushed.
         """
-        _, repo_url = self.get_repo_info()
-        default_branch = self.get_default_gh_branch(repo_url)
-        return f"{repo_url.strip('/')}/blob/{default_branch}/{file_path}"
+        context = self.get_repo_context()
+        default_branch = context.default_branch or self.get_default_gh_branch(context.url)
+        return f"{context.url.strip('/')}/blob/{default_branch}/{file_path}"
 
 
     def add_files(self, files):
@@ -389,16 +1850,18 @@ class CrateMaker:
                         # or fetch_remote to put them in the right place.
                         if local_path:
                             file_id = local_path
+                        elif self.resolver.offline:
+                            self.mark_unresolved(url, "file contents")
                         else:
                             fetch_remote = True
-                    file_added = self.crate.add_file(
-                        file_id, properties=props, fetch_remote=fetch_remote
+                    file_added = self.index_entity(
+                        self.crate.add_file(file_id, properties=props, fetch_remote=fetch_remote)
                     )
                 elif local_path:
                     props["name"] = data_file.get("name", os.path.basename(local_path))
                     props.update(self.get_local_file_stats(local_path))
-                    file_added = self.crate.add_file(
-                        local_path, properties=props, dest_path=local_path
+                    file_added = self.index_entity(
+                        self.crate.add_file(local_path, properties=props, dest_path=local_path)
                     )
                 file_added = self.update_properties(
                     file_added, data_file, exclude=["localPath"]
@@ -411,9 +1874,8 @@ class CrateMaker:
         Check a data file's url to see if it's part of the data repo specified
         by the --data-repo parameter.
         """
-        owner, repo = self.get_gh_parts(self.data_repo)
-        if f"{owner}/{repo}" in data_file.get("url", ""):
-            return True
+        gh_url = parse_gh_url(data_file.get("url"))
+        return bool(gh_url) and gh_url.full_name == self.data_repo_name
 
     def filter_files(self, action_data, file_relation):
         files = listify(action_data.get(file_relation, []))
@@ -444,7 +1906,9 @@ class CrateMaker:
                     props[file_relation] = delistify(added_files)
                     for data_file in added_files:
                         file_dates.append(data_file.get("dateModified"))
-            props["endDate"] = sorted(file_dates)[-1]
+            # Files that couldn't be resolved offline have no dates
+            if file_dates := sorted(date for date in file_dates if date):
+                props["endDate"] = file_dates[-1]
             action = self.add_context_entity(props)
             action = self.update_properties(
                 action, action_data, exclude=["result", "object"]
@@ -454,6 +1918,8 @@ class CrateMaker:
         return added
 
     def add_python_version(self):
+        from rocrate.model.contextentity import ContextEntity
+
         # I could also get this from notebook metadata
         # Get the version components from the system
         major, minor, micro = sys.version_info[0:3]
@@ -468,7 +1934,7 @@ class CrateMaker:
             "url": url,
             "@type": ["ComputerLanguage", "SoftwareApplication"],
         }
-        return self.crate.add(
+        return self.add_entity(
             ContextEntity(self.crate, entity["@id"], properties=entity)
         )
 
@@ -476,14 +1942,70 @@ class CrateMaker:
         """
         Get title of the page at the supplied url.
         """
-        response = requests.get(url)
+        self.profiler.count_cache("resolved page titles", url in self.page_titles)
+        if url in self.page_title_errors:
+            raise self.page_title_errors[url]
+        if url not in self.page_titles:
+            self.page_titles[url] = self.fetch_page_title(url)
+        return self.page_titles[url]
+
+    def fetch_page_title(self, url):
+        with self.profiler.phase("page titles"):
+            title = self.resolver.get_page_title(url)
+        if title is None:
+            self.mark_unresolved(url, "title")
+        return title
+
+    def read_page_title(self, url):
+        # Pages without titles are cached too, so they're revalidated rather than fetched again
+        cached = self.cache.get(url) if self.cache else None
+        if cached:
+            if self.cache.is_fresh(cached):
+                self.profiler.count_cache("page titles", True)
+                return cached["title"]
+            self.profiler.count_request(url)
+            response = self.http_request(
+                "get", url, headers=self.cache.validators(cached), stream=True
+            )
+            if response.status_code == 304:
+                response.close()
+                self.profiler.count_cache("page titles", True)
+                self.cache.touch(url)
+                return cached["title"]
+        else:
+            self.profiler.count_request(url)
+            response = self.http_request("get", url, stream=True)
+        self.profiler.count_cache("page titles", False)
         if response.ok:
-            soup = BeautifulSoup(response.text, features="lxml")
-            return soup.title.string.strip()
+            title = read_title(response)
+            if self.cache:
+                self.cache.set(
+                    url,
+                    title=title,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                )
+            return title
+        response.close()
+
+    def read_nb_metadata(self, notebook):
+        """
+        Read the top-level metadata from a notebook file without loading its cells.
+        Uses ijson to stream the file if its compiled backend is available,
+        otherwise parses the JSON without nbformat's validation.
+        """
+        with open(notebook, "rb") as nb_file:
+            if ijson and ijson.backend.startswith("yajl2"):
+                return next(ijson.items(nb_file, "metadata", use_float=True), {})
+            return json.load(nb_file).get("metadata", {})
 
     def get_nb_metadata(self, notebook):
-        nb = nbformat.read(notebook, nbformat.NO_CONVERT)
-        return {k: v for k, v in nb.metadata.rocrate.items() if v}
+        if notebook not in self.nb_metadata:
+            with self.profiler.phase("notebook metadata"):
+                metadata = self.read_nb_metadata(notebook).get("rocrate", {})
+            self.nb_metadata[notebook] = {k: v for k, v in metadata.items() if v}
+        # Callers modify the metadata, so give them their own copy
+        return copy.deepcopy(self.nb_metadata[notebook])
 
     def add_notebook(self, notebook):
         gh_url = self.get_gh_file_url(notebook)
@@ -505,29 +2027,234 @@ class CrateMaker:
             "url": gh_url,
         }
         # Add notebook to crate
-        new_nb = self.crate.add_file(nb_id, properties=nb_props)
+        new_nb = self.index_entity(self.crate.add_file(nb_id, properties=nb_props))
         # Add properties from notebook metadata
         new_nb = self.update_properties(new_nb, nb_metadata)
         return new_nb
 
+    def load_crate_graph(self, crate_source="./"):
+        """
+        Load the entities of an existing crate as JSON-LD dicts, keyed by @id.
+        The metadata is only parsed once per run, with orjson if it's installed.
+        """
+        metadata_path = Path(crate_source, "ro-crate-metadata.json").resolve()
+        if metadata_path not in self.crate_graphs:
+            try:
+                content = metadata_path.read_bytes()
+            except FileNotFoundError:
+                return {}
+            metadata = orjson.loads(content) if orjson else json.loads(content)
+            self.crate_graphs[metadata_path] = {entity["@id"]: entity for entity in metadata["@graph"]}
+        return self.crate_graphs[metadata_path]
+
+    def get_settings_fingerprint(self):
+        """
+        Fingerprint the inputs shared by all notebooks: the defaults, the data repo,
+        the file stats settings and this script. If any of them change, every notebook
+        is regenerated.
+        """
+        defaults = json.dumps(self.defaults, sort_keys=True).encode()
+        return {
+            "defaults": hashlib.sha256(defaults).hexdigest(),
+            "data_repo": self.data_repo,
+            "csv_records": self.csv_records,
+            "recursive_dir_stats": self.recursive_dir_stats,
+            "checksums": self.checksums,
+            "script": content_fingerprint(__file__),
+        }
+
+    def load_manifest(self, crate_source):
+        """
+        Load the notebook fingerprints recorded by the last incremental run.
+        Returns an empty dict if there's no manifest, or the shared settings have changed.
+        """
+        try:
+            manifest = json.loads(Path(crate_source, MANIFEST_NAME).read_text())
+        except FileNotFoundError:
+            return {}
+        if manifest.get("settings") != self.get_settings_fingerprint():
+            return {}
+        return manifest.get("notebooks", {})
+
+    def write_manifest(self, crate_source, notebooks):
+        manifest = {"settings": self.get_settings_fingerprint(), "notebooks": notebooks}
+        with atomic_write(Path(crate_source, MANIFEST_NAME), keep_unchanged=self.reproducible) as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+
+    def write_crate(self, crate_source):
+        """
+        Write the crate's files, then stream its metadata to ro-crate-metadata.json.
+        Files go first, as writing remote files updates their metadata. The metadata
+        replaces the old version only once it's complete, so an interrupted run
+        never leaves a truncated crate.
+
+        In reproducible mode the crate's own entities come first, followed by the
+        rest sorted by id, and an unchanged ro-crate-metadata.json isn't rewritten.
+
+        Returns:
+            True if ro-crate-metadata.json changed
+        """
+        base_path = Path(crate_source)
+        base_path.mkdir(parents=True, exist_ok=True)
+        metadata = self.crate.metadata
+        for algorithm in self.checksums:
+            if algorithm not in CONTEXT_CHECKSUMS:
+                metadata.extra_terms[algorithm] = f"{CHECKSUM_TERMS}{algorithm}"
+        for entity in self.crate.data_entities + self.crate.default_entities:
+            if entity is not metadata:
+                entity.write(base_path)
+        entities = None
+        if self.reproducible:
+            default_entities = self.crate.default_entities
+            entities = default_entities + sorted(
+                [entity for entity in self.crate.get_entities() if entity not in default_entities],
+                key=lambda entity: entity.id,
+            )
+        metadata_path = Path(base_path, metadata.id)
+        old_stats = metadata_path.stat() if metadata_path.exists() else None
+        with atomic_write(metadata_path, keep_unchanged=self.reproducible) as metadata_file:
+            for chunk in stream_jsonld(metadata, entities):
+                metadata_file.write(chunk)
+        self.crate_graphs.pop(metadata_path.resolve(), None)
+        # A changed file replaces the old one, so it has a new inode
+        return not old_stats or metadata_path.stat().st_ino != old_stats.st_ino
+
+    def carry_over_timestamps(self, old_graph):
+        """
+        Give entities the timestamps they had in the old crate, if nothing else
+        about them has changed.
+        """
+        for entity in self.crate.get_entities():
+            old_entity = old_graph.get(entity.id)
+            if not old_entity:
+                continue
+            timestamps = set()
+            for entity_type in listify(entity.type):
+                timestamps.update(TIMESTAMP_PROPERTIES.get(entity_type, []))
+            properties = entity.properties()
+            if {k: v for k, v in properties.items() if k not in timestamps} == {
+                k: v for k, v in old_entity.items() if k not in timestamps
+            }:
+                for key in timestamps & set(old_entity):
+                    properties[key] = old_entity[key]
+
+    def fingerprint_notebook(self, notebook, nb_id):
+        """
+        Record the entity id of a notebook and fingerprints of the notebook and
+        the local data files its actions refer to. Notebooks are fingerprinted by
+        their contents, data files (which can be large) by their size and modification time.
+        """
+        local_paths = [
+            data_file["localPath"]
+            for action_data in listify(self.get_nb_metadata(notebook).get("action", []))
+            for file_relation in ["result", "object"]
+            for data_file in self.filter_files(action_data, file_relation)
+            if data_file.get("localPath")
+        ]
+        return {
+            "id": nb_id,
+            "notebook": content_fingerprint(notebook),
+            "files": {path: fingerprint(path, self.recursive_dir_stats) for path in local_paths},
+        }
+
+    def is_unchanged(self, notebook, entry, old_graph):
+        """
+        Check a notebook's manifest entry to see if the notebook and its local data files
+        are the same as when the old crate was generated.
+        """
+        return (
+            bool(entry)
+            and entry["id"] in old_graph
+            and entry["notebook"] == content_fingerprint(notebook)
+            and all(
+                fingerprint(path, self.recursive_dir_stats) == value
+                for path, value in entry["files"].items()
+            )
+        )
+
+    def get_references(self, entity_ids, old_graph):
+        """
+        Get the ids of the given entities in the old crate, and all the entities they
+        refer to, directly or indirectly (excluding the root).
+        """
+        found = {}
+        to_check = list(entity_ids)
+        while to_check:
+            entity_id = to_check.pop(0)
+            if entity_id in found or entity_id not in old_graph or entity_id == "./":
+                continue
+            found[entity_id] = True
+            for value in old_graph[entity_id].values():
+                for item in listify(value):
+                    if isinstance(item, dict) and "@id" in item:
+                        to_check.append(item["@id"])
+        return list(found)
+
+    def carry_over_entity(self, entity, crate_source):
+        """
+        Add an entity from the old crate to the new one without changing it.
+        """
+        from rocrate.utils import is_url
+
+        properties = copy.deepcopy(entity)
+        entity_id = entity["@id"]
+        if "File" not in listify(entity["@type"]):
+            return self.add_context_entity(properties)
+        if is_url(entity_id):
+            return self.index_entity(self.crate.add_file(entity_id, properties=properties))
+        # Local files are either in the working directory, or have been copied to the crate
+        source = Path(entity_id)
+        if not source.exists():
+            source = Path(crate_source, entity_id)
+        return self.index_entity(
+            self.crate.add_file(
+                source if source.exists() else None, dest_path=entity_id, properties=properties
+            )
+        )
+
+    def carry_over_notebook(self, nb_id, old_graph, old_actions, crate_source):
+        """
+        Add an unchanged notebook from the old crate to the new one, along with the
+        actions it was the instrument of, and the entities they all refer to.
+        """
+        action_ids = old_actions.get(nb_id, [])
+        for entity_id in self.get_references([nb_id] + action_ids, old_graph):
+            # Shared entities like authors might already be in the crate, in which case
+            # they're updated just as they would be when adding the notebook
+            if entity := self.get_entity(entity_id):
+                for key, value in old_graph[entity_id].items():
+                    if not key.startswith("@"):
+                        entity[key] = copy.deepcopy(value)
+                self.index_entity(entity)
+            else:
+                self.carry_over_entity(old_graph[entity_id], crate_source)
+        for action_id in action_ids:
+            self.crate.root_dataset.append_to("mentions", self.get_entity(action_id))
+        return self.get_entity(nb_id)
+
     def get_old_crate_data(self, crate_source="./"):
+        """
+        Get the root properties, linked entities and versions of an existing crate,
+        as JSON-LD dicts, without building a full ROCrate.
+        """
         try:
-            old_crate = ROCrate(source=crate_source)
-            old_root = old_crate.get("./")
+            old_graph = self.load_crate_graph(crate_source)
             # Get the old root properties
-            old_props = old_root.properties()
+            old_props = old_graph["./"]
             # Add old properties to new record (except for those that will be populated from notebooks)
             root_props = {
                 k: v
                 for k, v in old_props.items()
                 if k in ["name", "description", "mainEntityOfPage"] and not isinstance(v, dict)
             }
-            entities = {k: old_crate.get(v["@id"]) for k, v in old_props.items()
-                if k in ["mainEntityOfPage", "license"] and isinstance(v, dict)}
+            entities = {k: old_graph[v["@id"]] for k, v in old_props.items()
+                if k in ["mainEntityOfPage", "license"] and isinstance(v, dict) and v["@id"] in old_graph}
             # Get version UpdateAction records for inclusion in new crate
-            versions = old_crate.get_by_type("UpdateAction")
+            versions = [
+                entity for entity in old_graph.values() if "UpdateAction" in listify(entity["@type"])
+            ]
         # If there's not an existing crate, try to set some default properties
-        except (ValueError, FileNotFoundError):
+        except (ValueError, KeyError):
             root_props = {}
             versions = []
             entities = {}
@@ -566,11 +2293,111 @@ class CrateMaker:
             versions = []
         return root_props, "./", entities, versions
 
+    def collect_urls(self, metadata, pages, files, local_files=None):
+        """
+        Collect the urls of pages that need titles, and of web files that need stats,
+        from a block of metadata. Pages that are already named, in the metadata or the
+        old crate, don't need titles.
+
+        Parameters:
+            metadata: a dict of notebook, root, or author metadata
+            pages: a set to add page urls to
+            files: a set to add web file urls to
+            local_files: a set to add the paths of local files to (optional)
+        """
+        for key, value in metadata.items():
+            if key == "action":
+                for action_data in listify(value):
+                    for file_relation in ["result", "object"]:
+                        for data_file in self.filter_files(action_data, file_relation):
+                            if data_file.get("url") and not data_file.get("localPath"):
+                                files.add(data_file["url"])
+                            elif data_file.get("localPath") and local_files is not None:
+                                local_files.add(data_file["localPath"])
+                            self.collect_urls(self.add_repo_link(dict(data_file)), pages, files, local_files)
+            elif key in ["license", "distribution"] or key not in CONTEXT_PROPERTIES:
+                continue
+            else:
+                for item in listify(value):
+                    if isinstance(item, str):
+                        if not self.get_old_name(item):
+                            pages.add(item)
+                    elif isinstance(item, dict):
+                        if key != "author" and item.get("url") and not item.get("name"):
+                            if not self.get_old_name(item["url"]):
+                                pages.add(item["url"])
+                        self.collect_urls(item, pages, files, local_files)
+
+    def resolve_urls(self, metadata_list):
+        """
+        Fetch the page titles, web file stats and local file stats needed by the crate
+        concurrently, so that building the crate doesn't wait on each one in turn.
+        The number of simultaneous requests to any one host is limited.
+
+        Parameters:
+            metadata_list: a list of metadata dicts to collect urls from
+        """
+        pages = set()
+        files = set()
+        local_files = set()
+        for metadata in metadata_list:
+            self.collect_urls(metadata, pages, files, local_files)
+        self.resolve_local_files(sorted(local_files))
+        self.resolver.index_gh_files([url for url in files if parse_gh_url(url)])
+        jobs = [(self.fetch_page_title, self.page_titles, self.page_title_errors, url) for url in pages]
+        jobs += [
+            (self.fetch_web_file_stats, self.web_file_stats, self.web_file_stats_errors, url)
+            for url in files
+        ]
+        hosts = {urlparse(url).netloc: threading.Semaphore(MAX_WORKERS_PER_HOST) for *_, url in jobs}
+
+        def resolve(job):
+            fetch, results, errors, url = job
+            with hosts[urlparse(url).netloc]:
+                try:
+                    results[url] = fetch(url)
+                # Failures are recorded and raised when the crate is built and the url
+                # is needed, rather than being fetched (and retried) again
+                except Exception as error:
+                    errors[url] = error
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(resolve, jobs))
+
     def update_crate(self):
-        if self.data_repo:
-            root_props, crate_source, entities, versions = self.prepare_data_crate()
-        else:
-            root_props, crate_source, entities, versions = self.prepare_code_crate()
+        from rocrate.rocrate import ROCrate
+
+        with self.profiler.phase("load old crate"):
+            if self.data_repo:
+                root_props, crate_source, entities, versions = self.prepare_data_crate()
+            else:
+                root_props, crate_source, entities, versions = self.prepare_code_crate()
+        with self.profiler.phase("notebook discovery"):
+            notebooks = self.get_notebooks()
+        # In incremental mode, find the notebooks that can be carried over from the old crate
+        old_notebooks = self.load_manifest(crate_source) if self.incremental else {}
+        with self.profiler.phase("load old crate"):
+            self.old_graph = self.load_crate_graph(crate_source)
+        old_graph = self.old_graph if old_notebooks else {}
+        old_actions = {}
+        for entity in old_graph.values():
+            if "CreateAction" in listify(entity["@type"]) and "instrument" in entity:
+                old_actions.setdefault(entity["instrument"]["@id"], []).append(entity["@id"])
+        unchanged = [
+            notebook
+            for notebook in notebooks
+            if self.is_unchanged(notebook, old_notebooks.get(str(notebook)), old_graph)
+        ]
+        # Fetch everything we need from the web before building the crate
+        with self.profiler.phase("resolve urls"):
+            self.resolve_urls(
+                [root_props, {"author": self.defaults.get("authors", [])}]
+                + [
+                    self.add_repo_link(self.get_nb_metadata(notebook))
+                    for notebook in notebooks
+                    if notebook not in unchanged
+                ]
+            )
         self.crate = ROCrate()
         # Add properties to the root
         root = self.crate.get("./")
@@ -580,10 +2407,9 @@ class CrateMaker:
         root = self.update_properties(root, root_props)
         # Add version information
         for v in versions:
-            self.crate.add(v)
+            self.carry_over_entity(v, crate_source)
         for k, v in entities.items():
-            root[k] = self.id_ify(v.id)
-            self.crate.add(v)
+            root[k] = self.carry_over_entity(v, crate_source)
         # Add authors from defaults
         self.add_entities(root, "author", self.defaults.get("authors", []))
         # If this is a new version, change version number and add UpdateAction
@@ -591,15 +2417,41 @@ class CrateMaker:
             root["version"] = self.version
             self.add_update_action(self.version)
         # Add notebooks
-        for notebook in self.get_notebooks():
-            nb = self.add_notebook(notebook)
-            for author in listify(nb.get("author")):
-                if author not in root.get("author", []):
-                    root.append_to("author", author)
+        manifest = {}
+        nb_authors = []
+        for notebook in notebooks:
+            if notebook in unchanged:
+                entry = old_notebooks[str(notebook)]
+                with self.profiler.phase("carry over notebook", notebook=str(notebook)):
+                    nb = self.carry_over_notebook(entry["id"], old_graph, old_actions, crate_source)
+            else:
+                with self.profiler.phase("add notebook", notebook=str(notebook)):
+                    nb = self.add_notebook(notebook)
+                entry = self.fingerprint_notebook(notebook, nb.id)
+            manifest[str(notebook)] = entry
+            nb_authors.append(nb.get("author"))
+        # Add notebook authors to the root
+        if authors := self.merge_authors(root.get("author"), *nb_authors):
+            root["author"] = delistify(authors)
         # Set licence of crate metadata
-        root["license"] = self.add_context_entity(LICENCES["metadata"])
+        root["license"] = self.add_context_entity(load_licences()["metadata"])
+        # The root's references have changed as entities were added to it
+        self.index_entity(root)
+        if self.reproducible:
+            self.carry_over_timestamps(self.load_crate_graph(crate_source))
         # Save crate
-        self.crate.write(crate_source)
+        with self.profiler.phase("write crate"):
+            changed = self.write_crate(crate_source)
+        if not changed:
+            print(f"{Path(crate_source, self.crate.metadata.id)} is unchanged")
+        if self.incremental:
+            self.write_manifest(crate_source, manifest)
+        if saved := len(self.named_pages - set(self.page_titles)):
+            print(f"Skipped fetching the titles of {saved} pages that already had names")
+        if self.unresolved:
+            print(f"Metadata missing for {len(self.unresolved)} urls not found offline:", file=sys.stderr)
+            for url, missing in sorted(self.unresolved.items()):
+                print(f"  {url} ({', '.join(sorted(missing))})", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -617,10 +2469,88 @@ if __name__ == "__main__":
         "--version", type=str, help="New version number", required=False
     )
     parser.add_argument("--data-repo", type=str, default="", required=False)
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Don't use the cache of web page metadata"
+    )
+    parser.add_argument(
+        "--csv-records",
+        action="store_true",
+        help="Count CSV records, allowing for newlines in quoted fields, rather than lines",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only regenerate notebooks that have changed since the last incremental run",
+    )
+    parser.add_argument(
+        "--recursive-dir-stats",
+        action="store_true",
+        help="Describe directories by the number, total size and formats of the files in them and their subdirectories",
+    )
+    parser.add_argument(
+        "--checksums",
+        type=str,
+        nargs="*",
+        help="Add checksums of local files with these algorithms (default: sha256), eg sha256 xxh3_64",
+    )
+    parser.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Sort entities and keep old timestamps if nothing else has changed, so an unchanged crate isn't rewritten",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=HTTP_TIMEOUT,
+        help=f"Seconds to wait for a connection or response from a web site or GitHub (default: {HTTP_TIMEOUT})",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=HOST_RATE,
+        help=f"Maximum requests per second to any one web site (default: {HOST_RATE})",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="crate-profile.json",
+        help="Save phase timings, request and cache counts to this file (default: crate-profile.json)",
+    )
+    parser.add_argument(
+        "--trace", type=str, help="Save phase timings as trace spans (JSON lines) to this file"
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Don't use the network, only metadata from the cache (however old it is)",
+    )
+    parser.add_argument(
+        "--fixtures",
+        type=str,
+        help="Work offline, using page titles, file stats and GitHub branches from this JSON file",
+    )
     args = parser.parse_args()
     if args.defaults:
         defaults = json.loads(Path(args.defaults).read_text())
     else:
         defaults = {}
 
-    main(defaults=defaults, crate_path=args.crate_path, version=args.version, data_repo=args.data_repo)
+    main(
+        defaults=defaults,
+        crate_path=args.crate_path,
+        version=args.version,
+        data_repo=args.data_repo,
+        use_cache=not args.no_cache,
+        csv_records=args.csv_records,
+        incremental=args.incremental,
+        recursive_dir_stats=args.recursive_dir_stats,
+        checksums=args.checksums if args.checksums != [] else ["sha256"],
+        reproducible=args.reproducible,
+        timeout=args.timeout,
+        host_rate=args.rate_limit,
+        profile=args.profile,
+        trace=args.trace,
+        offline=args.offline,
+        fixtures=args.fixtures,
+    )